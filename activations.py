@@ -0,0 +1,129 @@
+# Activation functions for logreg.py and neuralnet-bias.py
+# Every derivative is written in terms of the output y = g(x), so backprop
+# can reuse the activations saved in the forward pass instead of
+# recomputing exponentials. Data is stacked as columns, as in the learners.
+
+import numpy as np
+
+
+class Activation():
+    """An activation function together with its derivative.
+    forward(x, out=None) computes g(x); derivative(y, out=None) computes
+    g'(x) from y = g(x). Both work in place when given out."""
+    def __init__(self, name, forward, derivative):
+        self.name = name
+        self.forward = forward
+        self.derivative = derivative
+
+    def __call__(self, x, out=None):
+        return self.forward(x, out)
+
+    def backprop(self, delta, y, tmp=None):
+        """Multiplies delta in place by g' at the output y; tmp, if given,
+        is scratch space of the same shape"""
+        delta *= self.derivative(y, out=tmp)
+        return delta
+
+
+class Softmax(Activation):
+    """Softmax over each column. Its derivative is not elementwise, so
+    backprop applies the full Jacobian: delta <- y * (delta - sum(y*delta))"""
+    def __init__(self):
+        Activation.__init__(self, "softmax", softmax, softmax_diag)
+
+    def backprop(self, delta, y, tmp=None):
+        tmp = np.multiply(y, delta, out=tmp)
+        delta -= np.sum(tmp, axis=0, keepdims=True)
+        delta *= y
+        return delta
+
+
+def sigmoid(x, out=None):
+    """Logistic function from e = exp(-|x|), which cannot overflow and keeps
+    full precision in both tails: 1/(1+e) for x >= 0, e/(1+e) for x < 0"""
+    negative = x < 0
+    e = np.exp(-np.abs(x))
+    out = np.add(1, e, out=out)
+    np.reciprocal(out, out=out)
+    np.multiply(out, e, out=out, where=negative)
+    return out
+
+def sigmoid_prime(y, out=None):
+    out = np.subtract(1, y, out=out)
+    out *= y
+    return out
+
+def tanh(x, out=None):
+    return np.tanh(x, out=out)
+
+def tanh_prime(y, out=None):
+    out = np.square(y, out=out)
+    return np.subtract(1, out, out=out)
+
+def relu(x, out=None):
+    return np.maximum(x, 0, out=out)
+
+def relu_prime(y, out=None):
+    if out is None:
+        return (y > 0).astype(y.dtype)
+    return np.greater(y, 0, out=out)
+
+def identity(x, out=None):
+    if out is None or out is x:
+        return x
+    np.copyto(out, x)
+    return out
+
+def identity_prime(y, out=None):
+    if out is None:
+        return np.ones_like(y)
+    out.fill(1)
+    return out
+
+def softmax(x, out=None):
+    """Softmax over each column, shifted by the column max for stability"""
+    out = np.subtract(x, np.max(x, axis=0, keepdims=True), out=out)
+    np.exp(out, out=out)
+    out /= np.sum(out, axis=0, keepdims=True)
+    return out
+
+def softmax_diag(y, out=None):
+    """Diagonal of the softmax Jacobian"""
+    return sigmoid_prime(y, out)
+
+
+ACTIVATIONS = {a.name: a for a in [
+    Activation("sigmoid", sigmoid, sigmoid_prime),
+    Activation("tanh", tanh, tanh_prime),
+    Activation("relu", relu, relu_prime),
+    Activation("identity", identity, identity_prime),
+    Softmax(),
+]}
+
+
+def getActivation(g=None, dg=None):
+    """Resolves a g/dg constructor argument: None means sigmoid, a string
+    is looked up in ACTIVATIONS, an Activation is used as is. A plain
+    function g needs dg, which gets the output of g as its argument."""
+    if g is None:
+        return ACTIVATIONS["sigmoid"]
+    if isinstance(g, Activation):
+        return g
+    if isinstance(g, str):
+        if g not in ACTIVATIONS:
+            raise ValueError("Unknown activation {0}".format(g))
+        return ACTIVATIONS[g]
+
+    def forward(x, out=None):
+        if out is None:
+            return g(x)
+        out[...] = g(x)
+        return out
+
+    def derivative(y, out=None):
+        if out is None:
+            return dg(y)
+        out[...] = dg(y)
+        return out
+
+    return Activation("custom", forward, derivative)
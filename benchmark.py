@@ -0,0 +1,151 @@
+# Benchmarks for the learners in logreg.py and neuralnet-bias.py
+# Trains on synthetic MNIST-shaped data (no download), sweeping batch
+# size, layer sizes and dtype, and reports samples/sec, per-iteration
+# latency percentiles, peak RSS, time to a target loss and inference
+# throughput. Every configuration runs in a fresh process, so its peak
+# RSS is its own. Results are written as JSON so runs can be compared.
+#
+#   python benchmark.py --out bench.json [--quick]
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import time
+import numpy as np
+
+from mnistdata import syntheticMnist
+from models import loadModule
+
+
+def peakRssMb():
+    """Peak resident set size of this process so far (ru_maxrss is in KB
+    on Linux, bytes on macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0**2 if platform.system() == "Darwin" else 1024.0)
+
+
+def run(model, loss, X, y, batchsize, niter, target, evalevery, **fitargs):
+    """Times niter partial_fit steps on random batches. loss() is
+    evaluated every evalevery steps, outside the timings."""
+    latencies = np.empty(niter)
+    elapsed = 0.0
+    to_target = None
+    for t in range(niter):
+        idx = np.random.randint(0, len(X), size=batchsize)
+        start = time.perf_counter()
+        model.partial_fit(X[idx], y[idx], **fitargs)
+        latencies[t] = time.perf_counter() - start
+        elapsed += latencies[t]
+        if to_target is None and (t+1) % evalevery == 0 and loss() <= target:
+            to_target = elapsed
+    return {
+        "samples_per_sec": batchsize * niter / elapsed,
+        "latency_ms": {"p50": 1000*np.percentile(latencies, 50),
+                       "p90": 1000*np.percentile(latencies, 90),
+                       "p99": 1000*np.percentile(latencies, 99)},
+        "time_to_target_s": to_target,
+        "final_loss": float(loss()),
+    }
+
+
+def inferenceRate(predict, X, repeats=3):
+    best = min(timed(predict, X) for _ in range(repeats))
+    return len(X) / best
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+def isolated(f, *args):
+    """f(*args) in a freshly spawned process, so peakRssMb in f only
+    accounts for that one call"""
+    with mp.get_context("spawn").Pool(1) as pool:
+        return pool.apply(f, args)
+
+
+def loadData(args):
+    X, y = syntheticMnist(args.ntrain + args.neval, seed=args.seed)
+    return X[:args.ntrain], y[:args.ntrain], X[args.ntrain:], y[args.ntrain:]
+
+
+def benchNN(sizes, batchsize, dtype, args):
+    nn = loadModule("neuralnet_bias", "neuralnet-bias.py")
+    X, y, Xeval, yeval = loadData(args)
+    np.random.seed(args.seed)
+    net = nn.NN(len(sizes), sizes, dtype=dtype)
+    Xe = Xeval.T.astype(dtype)
+    ye = np.eye(sizes[-1])[:, yeval]
+    result = run(net, lambda: net.batch_error(Xe, ye), X.astype(dtype), y,
+                 batchsize, args.niter, args.nn_target, args.evalevery,
+                 alpha=args.nn_alpha)
+    result["inference_samples_per_sec"] = inferenceRate(net.forward_batch, Xeval.astype(dtype))
+    result.update({"model": "NN", "sizes": sizes, "batchsize": batchsize,
+                   "dtype": np.dtype(dtype).name, "peak_rss_mb": peakRssMb()})
+    return result
+
+
+def benchLogreg(batchsize, args):
+    """LogisticRegression keeps float64 weights, so it has no dtype axis"""
+    logreg = loadModule("logreg", "logreg.py")
+    X, y, Xeval, yeval = loadData(args)
+    X, Xeval = X.astype(np.float64), Xeval.astype(np.float64)
+    np.random.seed(args.seed)
+    model = logreg.LogisticRegression(X.shape[1], 10)
+    Xe = Xeval.T
+    ye = np.eye(10)[:, yeval]
+    result = run(model, lambda: model.loss_and_gradient(Xe, ye)[0], X, y,
+                 batchsize, args.niter, args.logreg_target, args.evalevery,
+                 alpha=args.logreg_alpha)
+    result["inference_samples_per_sec"] = inferenceRate(model.predict_batch, Xeval)
+    result.update({"model": "LogisticRegression", "sizes": [X.shape[1], 10],
+                   "batchsize": batchsize, "dtype": "float64",
+                   "peak_rss_mb": peakRssMb()})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks NN and LogisticRegression on synthetic data")
+    parser.add_argument("--out", default="bench.json")
+    parser.add_argument("--quick", action="store_true", help="small sweep, for a smoke test")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ntrain", type=int, default=20000)
+    parser.add_argument("--neval", type=int, default=2000)
+    parser.add_argument("--niter", type=int, default=200)
+    parser.add_argument("--evalevery", type=int, default=10)
+    parser.add_argument("--nn-alpha", type=float, default=0.5)
+    parser.add_argument("--nn-target", type=float, default=0.5, help="mean L2 error")
+    parser.add_argument("--logreg-alpha", type=float, default=0.15)
+    parser.add_argument("--logreg-target", type=float, default=0.5, help="cross-entropy")
+    args = parser.parse_args()
+
+    batchsizes = [1, 32, 128]
+    layers = [[784, 50, 10], [784, 100, 10], [784, 100, 50, 10]]
+    dtypes = [np.float64, np.float32]
+    if args.quick:
+        args.ntrain, args.neval, args.niter = 2000, 500, 50
+        batchsizes, layers = [32], [[784, 50, 10]]
+
+    results = []
+    for batchsize in batchsizes:
+        for dtype in dtypes:
+            for sizes in layers:
+                results.append(isolated(benchNN, sizes, batchsize, dtype, args))
+                print(json.dumps(results[-1]))
+        results.append(isolated(benchLogreg, batchsize, args))
+        print(json.dumps(results[-1]))
+
+    meta = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "numpy": np.__version__, "machine": platform.machine(),
+            "platform": platform.platform(), "cpus": os.cpu_count(), "args": vars(args)}
+    with open(args.out, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
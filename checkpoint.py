@@ -0,0 +1,44 @@
+# Versioned checkpoint format for the models in logreg.py and neuralnet-bias.py
+# A checkpoint is a directory with model.json, holding the format version,
+# the model kind and its hyperparameters, and weights.npy, all weight
+# arrays flattened into one contiguous array. Loading memory-maps
+# weights.npy, so scoring processes share one copy in the page cache.
+
+import json
+import os
+import numpy as np
+
+FORMAT_VERSION = 1
+
+
+def saveArrays(path, kind, meta, arrays):
+    """Writes arrays (all of one dtype) and the dict meta under path"""
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    dtype = np.result_type(*arrays)
+    flat = np.concatenate([np.asarray(a, dtype=dtype).ravel() for a in arrays])
+    np.save(os.path.join(path, "weights.npy"), flat)
+    header = {"version": FORMAT_VERSION, "kind": kind, "dtype": dtype.name,
+              "shapes": [list(a.shape) for a in arrays], "meta": meta}
+    with open(os.path.join(path, "model.json"), "w") as f:
+        json.dump(header, f, indent=1)
+
+
+def loadArrays(path, kind, mmap_mode='r'):
+    """Returns (meta, arrays) saved by saveArrays. The arrays are views of
+    one memmap; mmap_mode='c' makes them writable without touching the
+    file, None reads them into memory."""
+    with open(os.path.join(path, "model.json")) as f:
+        header = json.load(f)
+    if header["version"] != FORMAT_VERSION:
+        raise ValueError("Unsupported checkpoint version {0}".format(header["version"]))
+    if header["kind"] != kind:
+        raise ValueError("Checkpoint holds a {0}, not a {1}".format(header["kind"], kind))
+    flat = np.load(os.path.join(path, "weights.npy"), mmap_mode=mmap_mode)
+    arrays = []
+    start = 0
+    for shape in header["shapes"]:
+        size = int(np.prod(shape))
+        arrays.append(flat[start:start+size].reshape(shape))
+        start += size
+    return header["meta"], arrays
@@ -0,0 +1,52 @@
+# Randomized gradient checking for logreg.py and neuralnet-bias.py
+# Instead of perturbing every weight, compares the analytic gradient with
+# central differences along a few random directions and at a random
+# sample of coordinates, so a check costs O(ndirections + ncoords) passes
+
+import numpy as np
+
+
+def relativeError(a, b):
+    return abs(a - b) / max(abs(a), abs(b), 1e-8)
+
+
+def checkGradient(params, loss, grads, ndirections=5, ncoords=20, eps=1e-6):
+    """Checks grads, the analytic gradient of loss() w.r.t. the list of
+    arrays params. The params are perturbed in place and restored exactly
+    afterwards. Returns the largest relative error seen."""
+    saved = [p.copy() for p in params]
+    worst = 0.0
+    try:
+        for _ in range(ndirections):
+            direction = [np.random.randn(*p.shape) for p in params]
+            scale = np.sqrt(sum(np.sum(d*d) for d in direction))
+            direction = [d / scale for d in direction]
+            for p, s, d in zip(params, saved, direction):
+                p[...] = s + eps*d
+            high = loss()
+            for p, s, d in zip(params, saved, direction):
+                p[...] = s - eps*d
+            low = loss()
+            for p, s in zip(params, saved):
+                p[...] = s
+            numerical = (high - low) / (2*eps)
+            analytic = sum(np.sum(g*d) for g, d in zip(grads, direction))
+            worst = max(worst, relativeError(numerical, analytic))
+
+        sizes = np.array([p.size for p in params])
+        picks = np.random.choice(sizes.sum(), min(ncoords, sizes.sum()), replace=False)
+        for pick in picks:
+            l = np.searchsorted(np.cumsum(sizes), pick, side='right')
+            idx = np.unravel_index(pick - sizes[:l].sum(), params[l].shape)
+            value = params[l][idx]
+            params[l][idx] = value + eps
+            high = loss()
+            params[l][idx] = value - eps
+            low = loss()
+            params[l][idx] = value
+            numerical = (high - low) / (2*eps)
+            worst = max(worst, relativeError(numerical, grads[l][idx]))
+    finally:
+        for p, s in zip(params, saved):
+            p[...] = s
+    return worst
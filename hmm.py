@@ -2,9 +2,15 @@
 #Hidden Markov Model learning algorithm and Viterbi algorithm for most likely sequence of states
 #written as a part of Computational Linguistics class
 
+import csv
+import os
 import random
 import sys
+import multiprocessing as mp
 from math import log
+from collections import Counter
+from collections.abc import Mapping, MutableMapping
+import numpy as np
 
 PREC = 3
 
@@ -17,255 +23,684 @@ def genRandDist(n):
 def plog(x):
     return -1 * log(x,2)
 
-def mergeDicts(dict1, dict2):
-    """sums the values of two dicts that have the same keys, possibly recursively"""
-    result = dict1
-    for item in dict2:
-        if type(dict2[item]) == dict:
-            result[item] = mergeDicts(dict1[item], dict2[item])
+def wordCounts(corpus):
+    """Frequency of every distinct word of a corpus, given either as a list
+    of words or already as a dict of counts"""
+    if isinstance(corpus, Mapping):
+        return corpus
+    return Counter(corpus)
+
+def readCorpus(path, end="#", encoding="utf-8"):
+    """Counts the distinct words of a text file, read one line at a time so
+    the file is never held in memory. end is appended to every word, like
+    the "#" closing the words of the sample corpus."""
+    counts = Counter()
+    with open(path, encoding=encoding) as f:
+        for line in f:
+            counts.update(word + end for word in line.split())
+    return counts
+
+
+#trace levels: what the log of an HMM shows
+SUMMARY = 1 #parameters before and after training, corpus soft counts, log-likelihood per iteration
+DETAIL = 2 #also every step of the forward and backward passes, and the soft counts of every word
+
+class Trace():
+    """Buffered trace log of an HMM. Callers check enabled(level) before
+    formatting anything, so disabled levels cost nothing. Trellises can
+    also be dumped as numbers: CSV rows (word, kind, t, value per state)
+    if trellisPath ends in .csv, else binary .npy records (see
+    readTrellisDump). Use as a context manager, or close() when done."""
+    def __init__(self, path=None, level=DETAIL, trellisPath=None, buffering=1 << 20):
+        self.out = open(path, "w", buffering=buffering) if path is not None else None
+        self.level = level if path is not None else 0
+        self.dump = None
+        if trellisPath is not None:
+            self.binary = not trellisPath.endswith(".csv")
+            self.dump = open(trellisPath, "wb" if self.binary else "w", buffering=buffering, **({} if self.binary else {"newline": ""}))
+            self.rows = None if self.binary else csv.writer(self.dump)
+
+    def enabled(self, level):
+        return level <= self.level
+
+    def write(self, text):
+        self.out.write(text)
+
+    def writelines(self, lines):
+        self.out.writelines(lines)
+
+    def dumpTrellis(self, word, kind, array):
+        """array has one row per time step"""
+        if self.binary:
+            np.save(self.dump, np.array([word, kind]))
+            np.save(self.dump, array)
         else:
-            result[item] += dict2[item]
-    return result
+            self.rows.writerows([word, kind, t] + row for (t, row) in enumerate(array.tolist()))
+
+    def close(self):
+        for f in (self.out, self.dump):
+            if f is not None:
+                f.close()
+        self.out = self.dump = None
+        self.level = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def readTrellisDump(path):
+    """Yields (word, kind, array) from a binary trellis dump"""
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        while f.tell() < size:
+            word, kind = np.load(f)
+            yield str(word), str(kind), np.load(f)
+
+
+FIT = {} #model, distinct words and their counts during a fit, set before the workers are forked
+
+def eStep(job):
+    """Expected counts for FIT["words"][start:end], weighted by their
+    counts, under the parameters pi, A, B; run in a worker process by HMM.fit"""
+    (start, end, pi, A, B) = job
+    model = FIT["model"]
+    model.pi[:], model.A[:], model.B[:] = pi, A, B
+    return model.expectedCounts(FIT["words"][start:end], FIT["weights"][start:end])
+
+
+class ArrayView(MutableMapping):
+    """Dict-like view of a 1-d array, with keys mapped to positions by index.
+    Reads and writes go straight to the array."""
+    def __init__(self, array, index):
+        self.array = array
+        self.index = index
+
+    def __getitem__(self, key):
+        return float(self.array[self.index[key]])
+
+    def __setitem__(self, key, value):
+        self.array[self.index[key]] = value
+
+    def __delitem__(self, key):
+        raise TypeError("keys of an array view are fixed")
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class MatrixView(Mapping):
+    """Dict of dicts view of a 2-d array: view[row][col]"""
+    def __init__(self, array, rowIndex, colIndex):
+        self.array = array
+        self.rowIndex = rowIndex
+        self.colIndex = colIndex
+
+    def __getitem__(self, key):
+        return ArrayView(self.array[self.rowIndex[key]], self.colIndex)
+
+    def __setitem__(self, key, values):
+        row = self[key]
+        for col in values:
+            row[col] = values[col]
+
+    def __iter__(self):
+        return iter(self.rowIndex)
+
+    def __len__(self):
+        return len(self.rowIndex)
+
+    def __repr__(self):
+        return repr({key: dict(self[key]) for key in self})
+
+
+class PairView(Mapping):
+    """Dict view of a 3-d array of soft counts: view[(orig, dest)][letter]"""
+    def __init__(self, array, stateIndex, letterIndex):
+        self.array = array
+        self.stateIndex = stateIndex
+        self.letterIndex = letterIndex
+
+    def __getitem__(self, pair):
+        (orig, dest) = pair
+        return ArrayView(self.array[self.stateIndex[orig], self.stateIndex[dest]], self.letterIndex)
+
+    def __iter__(self):
+        return ((orig, dest) for orig in self.stateIndex for dest in self.stateIndex)
+
+    def __len__(self):
+        return len(self.stateIndex)**2
+
+    def __repr__(self):
+        return repr({pair: dict(self[pair]) for pair in self})
 
 
 class HMM():
     def __init__(self, states=[0, 1], letters=["b","a","d","i", "#"], verboseFlag=True, out_path="log.txt", corpus = [],
-                 initial=None, transitions=None, emissions=None):
+                 initial=None, transitions=None, emissions=None, cacheBytes=64 << 20,
+                 traceLevel=DETAIL, trellisDump=None):
         self.states = states
         self.verboseFlag = verboseFlag
         self.letters = letters
         self.corpus = corpus
-        self.softCounts = {(orig, dest): {letter : 0 for letter in self.letters} for orig in self.states for dest in self.states}
-        self.initialSoftCounts = {(orig, dest): {letter : 0 for letter in self.letters} for orig in self.states for dest in self.states}
-        if initial == None:
-            dist = genRandDist(len(states))
-            self.initial = dict(zip(states, dist))
-        else:
-            self.initial = initial
+        #the model is stored in arrays, indexed by position of states and letters:
+        #pi[i] initial, A[i][j] transition i->j, B[i][k] emission of letter k from i
+        self.stateIds = {state: i for (i, state) in enumerate(states)}
+        self.letterIds = {letter: k for (k, letter) in enumerate(letters)}
+        S, L = len(states), len(letters)
+        self.pi = np.empty(S)
+        self.A = np.empty((S, S))
+        self.B = np.empty((S, L))
 
+        if initial == None:
+            initial = dict(zip(states, genRandDist(len(states))))
         if transitions == None:
-            self.transitions = {}
+            transitions = {}
             for state in states:
                 dist = genRandDist(len(list(states)))
-                self.transitions[state] = dict(zip(states, dist))
-        else:
-            self.transitions = transitions
-
+                transitions[state] = dict(zip(states, dist))
         if emissions == None:
-            self.emissions = {}
+            emissions = {}
             for state in states:
                 dist = genRandDist(len(letters))
-                self.emissions[state] = dict(zip(letters, dist))
-        else:
-            self.emissions = emissions      
-
-
-        if verboseFlag:
-            self.out = open(out_path, "w+")
-            self.out.write("INITIALIZATION\n---------------------\n")
-            self.out.write(self.strStateInfo())
+                emissions[state] = dict(zip(letters, dist))
 
+        #the dict attributes are views of the arrays
+        self.initial = ArrayView(self.pi, self.stateIds)
+        self.transitions = MatrixView(self.A, self.stateIds, self.stateIds)
+        self.emissions = MatrixView(self.B, self.stateIds, self.letterIds)
+        for state in states:
+            self.initial[state] = initial[state]
+            self.transitions[state] = transitions[state]
+            self.emissions[state] = emissions[state]
 
+        #expected counts of arcs orig->dest emitting a letter, over the corpus
+        self.softCounts = PairView(np.zeros((S, S, L)), self.stateIds, self.letterIds)
+        self.initialSoftCounts = PairView(np.zeros((S, S, L)), self.stateIds, self.letterIds)
+        self.corpusLogLikelihood = None
 
+        #trellises of words under the current parameters, see trellis()
+        self.cacheBytes = cacheBytes
+        self.trellisCache = {}
+        self.cachedBytes = 0
+        self.cachedParameters = None
 
-    def strStateInfo(self):
-        output = ""
-        for state in self.states:
-            output += "STATE {0}\n".format(state)
-            output += "Transitions\n"
-            for dest in self.states:
-                output += "\t{0} to {1}: {2}\n".format(state,dest,self.transitions[state][dest])
-            output+= "Emissions\n"
-            for letter in sorted(self.emissions[state], key=lambda v: self.emissions[state][v], reverse=True):
-                output += "\t{0}: {1}\n".format(letter, self.emissions[state][letter])
-            output+= "\tTotal: {0}\n\n".format(sum(self.emissions[state].values()))
 
-        output += "Initial probabilities\n"
-        for state in self.states:
-            output += "STATE {0}: {1}\n".format(state,self.initial[state])
-        output += "\n\n"
+        #verboseFlag turns the log on, traceLevel says how much goes into it
+        self.trace = Trace(out_path if verboseFlag else None, traceLevel, trellisDump)
+        if self.trace.enabled(SUMMARY):
+            self.trace.write("INITIALIZATION\n---------------------\n")
+            self.trace.write(self.strStateInfo())
 
-        return output
+    def close(self):
+        self.trace.close()
 
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc):
+        self.close()
 
-    def computeAlpha(self, word, verboseFlag = None):
+    def tracing(self, level, verboseFlag=None):
         if verboseFlag == None:
             verboseFlag = self.verboseFlag
-        alpha = self.initial #a_i(1) = pi_i
-        
-        if verboseFlag:
-            log = "----------\n"
-            log += "Calculating forward probabilities for '{0}'\nInitial values:\n".format(word)
-            for state in self.states:
-                log += "\tState {0}: {1}\n".format(state, alpha[state])
+        return verboseFlag and self.trace.enabled(level)
 
-        #time printed is actually t+2, as it was said in the lecture to start from 1, and first letter is emitted only after first state
-        for t in range(len(word)):
-            new_alpha = {}
-            for dest in self.states:
-                values = [(alpha[state] * self.emissions[state][word[t]] * self.transitions[state][dest], state) for state in self.states]
-                new_alpha[dest] = sum([value[0] for value in values])
 
-                if verboseFlag:
-                    log += "\t\tTo state {0}\n".format(dest)
-                    for value in values:
-                        log += "\t\t\tfrom state {0}: {1}\n".format(value[1], value[0])
 
-            alpha = new_alpha          
 
-            if verboseFlag:
-                log+= "\nProbabilities at time {0}, letter '{1}'\n".format(t+2, word[t])
-                for (state, prob) in alpha.items():
-                    log+= "\tState {0}: {1}\n".format(state, prob)
-        
-        final_alpha = sum(alpha.values())
-        if verboseFlag:
-            log += "\nFinal forward probability of string '{0}': {1}\n\n".format(word, final_alpha)
-            self.out.write(log)
+    def strStateInfo(self):
+        output = []
+        for state in self.states:
+            output.append("STATE {0}\n".format(state))
+            output.append("Transitions\n")
+            for dest in self.states:
+                output.append("\t{0} to {1}: {2}\n".format(state,dest,self.transitions[state][dest]))
+            output.append("Emissions\n")
+            for letter in sorted(self.emissions[state], key=lambda v: self.emissions[state][v], reverse=True):
+                output.append("\t{0}: {1}\n".format(letter, self.emissions[state][letter]))
+            output.append("\tTotal: {0}\n\n".format(sum(self.emissions[state].values())))
+
+        output.append("Initial probabilities\n")
+        for state in self.states:
+            output.append("STATE {0}: {1}\n".format(state,self.initial[state]))
+        output.append("\n\n")
+
+        return "".join(output)
+
+
+
+    def encode(self, word):
+        """Letter ids of a word, as an array"""
+        return np.array([self.letterIds[letter] for letter in word], dtype=np.intp)
+
+    def forwardTrellis(self, word):
+        """alpha[t][i], the probability of emitting the first t letters of
+        word and then being in state i; shape (len(word)+1, number of states)"""
+        ids = self.encode(word)
+        alpha = np.empty((len(ids)+1, len(self.states)))
+        alpha[0] = self.pi
+        for t in range(len(ids)):
+            alpha[t+1] = np.dot(alpha[t] * self.B[:, ids[t]], self.A)
+        return alpha
+
+    def backwardTrellis(self, word):
+        """beta[t][i], the probability of emitting the letters of word from
+        position t on, starting in state i; same shape as forwardTrellis"""
+        ids = self.encode(word)
+        beta = np.empty((len(ids)+1, len(self.states)))
+        beta[len(ids)] = 1
+        for t in reversed(range(len(ids))):
+            beta[t] = self.B[:, ids[t]] * np.dot(self.A, beta[t+1])
+        return beta
+
+    def scaledTrellis(self, word):
+        """Forward-backward pass rescaled at every step, so long sequences do
+        not underflow. Returns (alphaHat, betaHat, scales): alphaHat[t] is
+        alpha[t] normalized to sum to 1, scales[t] the factor it was divided
+        by (scales[0] = 1), and betaHat[t] is beta[t] divided by the product
+        of scales[t+1:]. log(P(word)) is the sum of log(scales)."""
+        ids = self.encode(word)
+        T, S = len(ids), len(self.states)
+        alphaHat = np.empty((T+1, S))
+        betaHat = np.empty((T+1, S))
+        scales = np.empty(T+1)
+        alphaHat[0] = self.pi
+        scales[0] = 1
+        for t in range(T):
+            a = np.dot(alphaHat[t] * self.B[:, ids[t]], self.A)
+            scales[t+1] = np.sum(a)
+            alphaHat[t+1] = a / scales[t+1]
+        betaHat[T] = 1
+        for t in reversed(range(T)):
+            betaHat[t] = self.B[:, ids[t]] * np.dot(self.A, betaHat[t+1]) / scales[t+1]
+        return alphaHat, betaHat, scales
+
+    def forwardBackward(self, word):
+        """One scaled forward and backward pass (see scaledTrellis)"""
+        return self.scaledTrellis(word)
+
+    def unscale(self, trellis):
+        """Raw alpha and beta from a scaled trellis; these underflow for
+        long words and are only meant for the log"""
+        alphaHat, betaHat, scales = trellis
+        suffix = np.ones(len(scales))
+        suffix[:-1] = np.cumprod(scales[::-1])[::-1][1:]
+        return alphaHat * np.cumprod(scales)[:, None], betaHat * suffix[:, None]
+
+    def validateCache(self):
+        """Empties the trellis cache if the parameters changed since it was
+        filled; called once before every pass over a corpus"""
+        parameters = (self.pi, self.A, self.B)
+        if self.cachedParameters is None or not all(np.array_equal(p, q) for p, q in zip(parameters, self.cachedParameters)):
+            self.trellisCache.clear()
+            self.cachedBytes = 0
+            self.cachedParameters = tuple(np.copy(p) for p in parameters)
+
+    def trellis(self, word):
+        """forwardBackward(word), kept for later passes with the same
+        parameters (e.g. soft counts, then the log-likelihood, or a corpus
+        with a few new words) while the cache holds less than cacheBytes"""
+        if word in self.trellisCache:
+            return self.trellisCache[word]
+        trellis = self.forwardBackward(word)
+        size = sum(a.nbytes for a in trellis)
+        if self.cachedBytes + size <= self.cacheBytes:
+            self.trellisCache[word] = trellis
+            self.cachedBytes += size
+        return trellis
+
+    def wordLogLikelihood(self, word, trellis=None):
+        """Natural log of the probability of word, without underflow"""
+        scales = (trellis if trellis is not None else self.scaledTrellis(word))[2]
+        return np.sum(np.log(scales))
+
+    def logLikelihood(self, corpus=None):
+        if corpus is None:
+            corpus = self.corpus
+        self.validateCache()
+        return sum(count * self.wordLogLikelihood(word, self.trellis(word))
+                   for word, count in wordCounts(corpus).items())
+
+    def computeAlpha(self, word, verboseFlag = None, alpha = None):
+        if verboseFlag == None:
+            verboseFlag = self.verboseFlag
+        if alpha is None:
+            alpha = self.forwardTrellis(word)
+        final_alpha = np.sum(alpha[-1])
+
+        if self.tracing(DETAIL, verboseFlag):
+            log = ["----------\n"]
+            log.append("Calculating forward probabilities for '{0}'\nInitial values:\n".format(word))
+            for state in self.states:
+                log.append("\tState {0}: {1}\n".format(state, alpha[0][self.stateIds[state]]))
+
+            #time printed is actually t+2, as it was said in the lecture to start from 1, and first letter is emitted only after first state
+            for t in range(len(word)):
+                #values[i][j]: contribution of state i at time t to state j at t+1
+                values = (alpha[t] * self.B[:, self.letterIds[word[t]]])[:, None] * self.A
+                for dest in self.states:
+                    log.append("\t\tTo state {0}\n".format(dest))
+                    for state in self.states:
+                        log.append("\t\t\tfrom state {0}: {1}\n".format(state, values[self.stateIds[state]][self.stateIds[dest]]))
+                log.append("\nProbabilities at time {0}, letter '{1}'\n".format(t+2, word[t]))
+                for state in self.states:
+                    log.append("\tState {0}: {1}\n".format(state, alpha[t+1][self.stateIds[state]]))
+            log.append("\nFinal forward probability of string '{0}': {1}\n\n".format(word, final_alpha))
+            self.trace.writelines(log)
         
         return final_alpha
 
-    def computeBeta(self, word, verboseFlag = None):        
+    def computeBeta(self, word, verboseFlag = None, beta = None):        
         if verboseFlag == None:
             verboseFlag = self.verboseFlag
-        beta = {state: 1 for state in self.states}         
-        
-        if verboseFlag:
-            log = "----------\n"
-            log += "Calculating backward probabilities for '{0}'\nInitial values:\n".format(word)
+        if beta is None:
+            beta = self.backwardTrellis(word)
+        final_beta = np.dot(beta[0], self.pi)
+
+        if self.tracing(DETAIL, verboseFlag):
+            log = ["----------\n"]
+            log.append("Calculating backward probabilities for '{0}'\nInitial values:\n".format(word))
             for state in self.states:
-                log += "\tState {0}: {1}\n".format(state, beta[state])
-
-        #time printed is actually t+2, as it was said in the lecture to start from 1, and first letter is emitted only after first state
-        for t in reversed(range(len(word))):
-            new_beta = {}
-            for origin in self.states:
-                values = [(beta[state] * self.emissions[origin][word[t]] * self.transitions[origin][state],state) for state in self.states]
-                new_beta[origin] = sum([value[0] for value in values])
-            
-                if verboseFlag:
-                    log += "\t\tFrom state {0}\n".format(origin)
-                    for value in values:
-                        log += "\t\t\tto state {0}: {1}\n".format(value[1], value[0])
-
-            beta = new_beta
-
-            if verboseFlag:
-                log+= "\nProbabilities at time {0}, letter '{1}'\n".format(t+2, word[t])
-                for (state, prob) in beta.items():
-                    log+= "\tState {0}: {1}\n".format(state, prob)
-
-        final_beta = sum([beta[state] * self.initial[state] for state in self.states])
-        if verboseFlag:
-            log += "\nFinal backward probability of string '{0}': {1}\n\n".format(word, final_beta)
-            self.out.write(log)
+                log.append("\tState {0}: {1}\n".format(state, beta[len(word)][self.stateIds[state]]))
+
+            #time printed is actually t+2, as it was said in the lecture to start from 1, and first letter is emitted only after first state
+            for t in reversed(range(len(word))):
+                #values[i][j]: contribution of state j at time t+1 to state i at t
+                values = self.B[:, self.letterIds[word[t]]][:, None] * self.A * beta[t+1]
+                for origin in self.states:
+                    log.append("\t\tFrom state {0}\n".format(origin))
+                    for state in self.states:
+                        log.append("\t\t\tto state {0}: {1}\n".format(state, values[self.stateIds[origin]][self.stateIds[state]]))
+                log.append("\nProbabilities at time {0}, letter '{1}'\n".format(t+2, word[t]))
+                for state in self.states:
+                    log.append("\tState {0}: {1}\n".format(state, beta[t][self.stateIds[state]]))
+            log.append("\nFinal backward probability of string '{0}': {1}\n\n".format(word, final_beta))
+            self.trace.writelines(log)
 
         return final_beta
 
 
     def computeAlphaPartial(self, word, state, numLetters):
-        alpha = self.initial
-
-        for t in range(numLetters):
-            new_alpha = {}
-            for dest in self.states:
-                values = [(alpha[state] * self.emissions[state][word[t]] * self.transitions[state][dest], state) for state in self.states]
-                new_alpha[dest] = sum([value[0] for value in values])
-
-            alpha = new_alpha          
-        return alpha[state]
+        return self.forwardTrellis(word[:numLetters])[numLetters][self.stateIds[state]]
 
     def computeBetaPartial(self, word, state, numLeftLetter):
-        beta = {state: 1 for state in self.states}    
-        for t in reversed(range(numLeftLetter, len(word))):
-            new_beta = {}
-            for origin in self.states:
-                values = [(beta[state] * self.emissions[origin][word[t]] * self.transitions[origin][state],state) for state in self.states]
-                new_beta[origin] = sum([value[0] for value in values])
-            beta = new_beta
-        return beta[state]        
-
-
-    def computeSoftCounts(self, word, verboseFlag = None):
-        if verboseFlag == None:
-            verboseFlag = self.verboseFlag
-
-        if verboseFlag:
-            log = "SOFT COUNTS for {0}\n-----------------------\n".format(word)
+        return self.backwardTrellis(word[numLeftLetter:])[0][self.stateIds[state]]
+
+
+    def arcPosteriors(self, word, trellis=None):
+        """xi[t][i][j], the probability of taking the arc i->j while
+        emitting letter t, given the word; read off one scaled
+        forward-backward pass (computed if trellis is not given)"""
+        alphaHat, betaHat, scales = trellis if trellis is not None else self.forwardBackward(word)
+        ids = self.encode(word)
+        emitted = alphaHat[:-1] * self.B[:, ids].T #alphaHat[t][i] * B[i][word[t]]
+        return emitted[:, :, None] * self.A[None, :, :] * (betaHat[1:] / scales[1:, None])[:, None, :]
+
+    def addPosteriors(self, counts, initialCounts, word, trellis, weight=1):
+        """Adds the arc posteriors of word, times weight, into (states,
+        states, letters) accumulators in place (either may be None), without
+        building xi: the steps t emitting letter k add up to
+        A * (alphaHat[t] * B[:, k]).T @ (betaHat[t+1] / scales[t+1]), one
+        matrix product per letter. Memory is O(T*S + S^2) per word."""
+        if len(word) == 0:
+            return
+        alphaHat, betaHat, scales = trellis
+        ids = self.encode(word)
+        right = betaHat[1:] / scales[1:, None]
+        if counts is not None:
+            #steps grouped by letter
+            order = np.argsort(ids, kind="stable")
+            letters, starts = np.unique(ids[order], return_index=True)
+            for k, ts in zip(letters, np.split(order, starts[1:])):
+                left = alphaHat[ts] * self.B[:, k]
+                counts[:, :, k] += weight * self.A * np.dot(left.T, right[ts])
+        if initialCounts is not None:
+            left = alphaHat[0] * self.B[:, ids[0]]
+            initialCounts[:, :, ids[0]] += weight * self.A * np.outer(left, right[0])
+
+    def wordCountsArray(self, word, trellis, initial=False):
+        counts = np.zeros((len(self.states), len(self.states), len(self.letters)))
+        if initial:
+            self.addPosteriors(None, counts, word, trellis)
+        else:
+            self.addPosteriors(counts, None, word, trellis)
+        return counts
+
+    def computeSoftCounts(self, word, verboseFlag = None, trellis = None):
+        if trellis is None:
+            trellis = self.forwardBackward(word)
+        softCounts = PairView(self.wordCountsArray(word, trellis), self.stateIds, self.letterIds)
+        if self.tracing(DETAIL, verboseFlag):
+            self.traceSoftCounts(word, trellis, softCounts)
+        return softCounts
 
-        wordProb = self.computeAlpha(word, verboseFlag=False)
-        softCounts = {(orig, dest): {letter : 0 for letter in self.letters} for orig in self.states for dest in self.states}
-        
+    def traceSoftCounts(self, word, trellis, softCounts=None):
+        """Per-letter posteriors and the counts table of one word, to the
+        log; xi is only built here, for words short enough to print"""
+        if softCounts is None:
+            softCounts = PairView(self.wordCountsArray(word, trellis), self.stateIds, self.letterIds)
+        xi = self.arcPosteriors(word, trellis)
+        log = ["SOFT COUNTS for {0}\n-----------------------\n".format(word)]
         for t in range(len(word)):
-            letter = word[t]
-            if verboseFlag:
-                log += "\tLetter: {0}\n".format(letter)
+            log.append("\tLetter: {0}\n".format(word[t]))
             for (orig, dest) in softCounts:
-                value = self.computeAlphaPartial(word, orig, t) * self.transitions[orig][dest] * \
-                        self.emissions[orig][letter] * self.computeBetaPartial(word, dest, t+1) / wordProb
-                softCounts[(orig, dest)][letter] += value
-
-                if verboseFlag:
-                    log += "\t\tFrom state {0} to state {1}: {2:.{P}f}\n".format(orig, dest, value, P=PREC)
-
-        if verboseFlag:
-            log += "\nExpected counts table: \n"
-            for letter in sorted(self.letters):
-                for (orig, dest) in softCounts:
-                    log += "\t{0}\t{1}\t{2}\t{3:.{P}f}\n".format(letter, orig, dest, softCounts[(orig,dest)][letter], P=PREC)                  
-            self.out.write(log)
-        
-        return softCounts
-
+                value = xi[t][self.stateIds[orig]][self.stateIds[dest]]
+                log.append("\t\tFrom state {0} to state {1}: {2:.{P}f}\n".format(orig, dest, value, P=PREC))
+        log.append("\nExpected counts table: \n")
+        log.extend(self.countsTable(softCounts))
+        self.trace.writelines(log)
 
-    def computeInitialSoftCounts(self, word, verboseFlag = None):
-        if verboseFlag == None:
-            verboseFlag = self.verboseFlag
 
-        wordProb = self.computeAlpha(word, verboseFlag=False)
-        softCounts = {(orig, dest): {letter : 0 for letter in self.letters} for orig in self.states for dest in self.states}
-        t = 0
-        letter = word[t]
-        for (orig, dest) in softCounts:
-                value = self.computeAlphaPartial(word, orig, t) * self.transitions[orig][dest] * \
-                        self.emissions[orig][letter] * self.computeBetaPartial(word, dest, t+1) / wordProb
-                softCounts[(orig, dest)][letter] += value
+    def computeInitialSoftCounts(self, word, verboseFlag = None, trellis = None):
+        if trellis is None:
+            trellis = self.forwardBackward(word)
+        return PairView(self.wordCountsArray(word, trellis, initial=True), self.stateIds, self.letterIds)
 
-        return softCounts
+    def countsTable(self, softCounts):
+        """Lines of letter, origin, destination and count"""
+        for letter in sorted(self.letters):
+            for (orig, dest) in softCounts:
+                yield "\t{0}\t{1}\t{2}\t{3:.{P}f}\n".format(letter, orig, dest, softCounts[(orig,dest)][letter], P=PREC)
 
     def showSoftCounts(self):
-        log = ""
-        log += "SOFT COUNTS FOR THE ENTIRE CORPUS\n-----------------------------\n"
-        for letter in sorted(self.letters):
-            for (orig, dest) in self.softCounts:
-                log += "\t{0}\t{1}\t{2}\t{3:.{P}f}\n".format(letter, orig, dest, self.softCounts[(orig,dest)][letter], P=PREC)
-        log += "\n\tInitial counts\n\t--------------\n"                
-        for letter in sorted(self.letters):
-            for (orig, dest) in self.initialSoftCounts:
-                log += "\t{0}\t{1}\t{2}\t{3:.{P}f}\n".format(letter, orig, dest, self.initialSoftCounts[(orig,dest)][letter], P=PREC)
-        return log
+        log = ["SOFT COUNTS FOR THE ENTIRE CORPUS\n-----------------------------\n"]
+        log.extend(self.countsTable(self.softCounts))
+        log.append("\n\tInitial counts\n\t--------------\n")
+        log.extend(self.countsTable(self.initialSoftCounts))
+        log.append("\nLog-likelihood of the corpus: {0}\n".format(self.corpusLogLikelihood))
+        return "".join(log)
 
     def setCorpusSoftCounts(self, verboseFlag = None):
         if verboseFlag == None:
             verboseFlag = self.verboseFlag
 
-        for word in self.corpus:
-            self.computeAlpha(word, verboseFlag)
-            self.computeBeta(word, verboseFlag) #those are just for printing to the log
-
-            wordSC = self.computeSoftCounts(word, verboseFlag)
-            wordISC = self.computeInitialSoftCounts(word, verboseFlag)
-
-            self.softCounts = mergeDicts(wordSC, self.softCounts)
-            self.initialSoftCounts = mergeDicts(wordISC, self.initialSoftCounts)
-
-        if verboseFlag:
-            log = self.showSoftCounts()
-            self.out.write(log)
+        self.corpusLogLikelihood = 0.0
+        self.validateCache()
+        #every distinct word is processed once and weighted by its count
+        for word, count in wordCounts(self.corpus).items():
+            #a single forward-backward pass per word, shared by everything below
+            trellis = self.trellis(word)
+            self.corpusLogLikelihood += count * self.wordLogLikelihood(word, trellis)
+            if self.tracing(DETAIL, verboseFlag):
+                alpha, beta = self.unscale(trellis)
+                self.computeAlpha(word, verboseFlag, alpha)
+                self.computeBeta(word, verboseFlag, beta) #those are just for printing to the log
+            if self.trace.dump is not None:
+                self.dumpTrellis(word, trellis)
+
+            #posteriors go straight into the corpus counts; a per-word table is only built for the log
+            self.addPosteriors(self.softCounts.array, self.initialSoftCounts.array, word, trellis, count)
+            if self.tracing(DETAIL, verboseFlag):
+                self.traceSoftCounts(word, trellis)
+
+        if self.tracing(SUMMARY, verboseFlag):
+            self.trace.write(self.showSoftCounts())
+
+    def dumpTrellis(self, word, trellis):
+        """Scaled trellis of word to the trellis dump (see scaledTrellis)"""
+        alphaHat, betaHat, scales = trellis
+        self.trace.dumpTrellis(word, "alphaHat", alphaHat)
+        self.trace.dumpTrellis(word, "betaHat", betaHat)
+        self.trace.dumpTrellis(word, "scales", scales[:, None])
+
+
+    def logParameters(self):
+        with np.errstate(divide='ignore'):
+            return np.log(self.pi), np.log(self.A), np.log(self.B)
+
+    def viterbi(self, word):
+        """Most likely states emitting the letters of word, and the log
+        probability of that path"""
+        paths, scores = self.viterbiBatch([word])
+        return paths[0], scores[0]
+
+    def viterbiBatch(self, words, chunksize=1024, maxBytes=32 << 20):
+        """Viterbi in log space for many words at once. Words are sorted by
+        length and decoded chunksize at a time, padded to the longest in
+        the chunk; past its end a word keeps its scores and points back to
+        the same states. Each step scores chunksize * states^2 candidate
+        arcs, so chunksize is lowered to keep those under maxBytes;
+        backpointers take len * chunksize * states small ints per chunk.
+        Returns (paths, scores) in the order of words."""
+        logPi, logA, logB = self.logParameters()
+        S = len(self.states)
+        pointerType = np.uint8 if S <= 256 else np.int32
+        stay = np.arange(S, dtype=pointerType)
+        chunksize = max(1, min(chunksize, maxBytes // (8 * S * S)))
+        order = sorted(range(len(words)), key=lambda i: len(words[i]))
+        paths = [None] * len(words)
+        scores = np.zeros(len(words))
+        for chunk in range(0, len(order), chunksize):
+            batch = order[chunk:chunk+chunksize]
+            lengths = np.array([len(words[i]) for i in batch])
+            T = lengths.max()
+            if T == 0:
+                for i in batch:
+                    paths[i] = []
+                continue
+            ids = np.zeros((len(batch), T), dtype=np.intp)
+            for b, i in enumerate(batch):
+                ids[b, :lengths[b]] = self.encode(words[i])
+            live = (np.arange(T)[None, :] < lengths[:, None]) #(batch, T) mask
+            pointers = np.empty((T, len(batch), S), dtype=pointerType)
+            delta = logPi + logB.T[ids[:, 0]]
+            for t in range(1, T):
+                candidates = delta[:, :, None] + logA #(batch, from, to)
+                best = np.argmax(candidates, axis=1)
+                stepped = np.take_along_axis(candidates, best[:, None, :], axis=1)[:, 0] + logB.T[ids[:, t]]
+                delta = np.where(live[:, t, None], stepped, delta)
+                pointers[t] = np.where(live[:, t, None], best, stay)
+            state = np.argmax(delta, axis=1)
+            chunkScores = delta[np.arange(len(batch)), state]
+            stateIds = np.empty((len(batch), T), dtype=np.intp)
+            stateIds[:, T-1] = state
+            for t in reversed(range(1, T)):
+                state = pointers[t][np.arange(len(batch)), state]
+                stateIds[:, t-1] = state
+            for b, i in enumerate(batch):
+                paths[i] = [self.states[k] for k in stateIds[b, :lengths[b]]]
+                scores[i] = chunkScores[b] if lengths[b] else 0.0
+        return paths, scores
+
+    def expectedCounts(self, words, weights=None):
+        """E-step over words, each counted weights[i] times (once by
+        default): (arc counts, initial arc counts, log-likelihood), the
+        counts as (states, states, letters) arrays"""
+        S, L = len(self.states), len(self.letters)
+        counts = np.zeros((S, S, L))
+        initialCounts = np.zeros((S, S, L))
+        logLikelihood = 0.0
+        for i, word in enumerate(words):
+            weight = 1 if weights is None else weights[i]
+            #not cached: the next M-step would make every trellis stale
+            trellis = self.forwardBackward(word)
+            self.addPosteriors(counts, initialCounts, word, trellis, weight)
+            logLikelihood += weight * self.wordLogLikelihood(word, trellis)
+        return counts, initialCounts, logLikelihood
+
+    def maximize(self, counts, initialCounts):
+        """M-step: parameters re-estimated from the expected counts. States
+        that were never visited keep their old distributions."""
+        def normalized(c, old):
+            total = np.sum(c, axis=-1, keepdims=True)
+            return np.where(total > 0, c / np.where(total > 0, total, 1), old)
+        self.pi[:] = normalized(np.sum(initialCounts, axis=(1, 2)), self.pi)
+        self.A[:] = normalized(np.sum(counts, axis=2), self.A)
+        self.B[:] = normalized(np.sum(counts, axis=1), self.B)
+
+    def fit(self, corpus=None, max_iter=100, tol=1e-6, nworkers=None, chunksize=None):
+        """Baum-Welch: alternates E- and M-steps until the corpus
+        log-likelihood improves by less than tol, or for max_iter M-steps;
+        a last E-step scores the final parameters. corpus is a list of words or a dict of word counts
+        (see readCorpus); each distinct word is scored once per iteration,
+        weighted by its count. The E-step is split into chunks of words
+        scored by a pool of nworkers processes (all cores by default, none
+        if 1), whose count arrays are summed. Returns the log-likelihood
+        before training and after every M-step; the soft counts are left at
+        those of the final model."""
+        if max_iter < 1:
+            raise ValueError("max_iter must be at least 1")
+        if corpus is not None:
+            self.corpus = corpus
+        frequencies = wordCounts(self.corpus)
+        words = list(frequencies)
+        weights = np.array([frequencies[word] for word in words], dtype=np.float64)
+        if nworkers is None:
+            nworkers = mp.cpu_count()
+        if chunksize is None:
+            chunksize = max(1, -(-len(words) // (4 * nworkers)))
+        starts = range(0, len(words), chunksize)
+
+        pool = None
+        if nworkers > 1 and len(starts) > 1:
+            ctx = mp.get_context("fork")
+            FIT["model"], FIT["words"], FIT["weights"] = self, words, weights
+            pool = ctx.Pool(nworkers)
+        def expect(iteration):
+            if pool is not None:
+                jobs = [(start, start + chunksize, self.pi, self.A, self.B) for start in starts]
+                results = pool.map(eStep, jobs)
+            else:
+                results = [self.expectedCounts(words, weights)]
+            logLikelihood = sum(r[2] for r in results)
+            history.append(logLikelihood)
+            if self.tracing(SUMMARY):
+                self.trace.write("Iteration {0}: log-likelihood {1}\n".format(iteration, logLikelihood))
+            return sum(r[0] for r in results), sum(r[1] for r in results)
+
+        history = []
+        try:
+            counts, initialCounts = expect(0)
+            for iteration in range(1, max_iter + 1):
+                self.maximize(counts, initialCounts)
+                counts, initialCounts = expect(iteration) #always those of the current parameters
+                if history[-1] - history[-2] < tol:
+                    break
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            FIT.clear()
+
+        self.softCounts.array[...] = counts
+        self.initialSoftCounts.array[...] = initialCounts
+        self.corpusLogLikelihood = history[-1]
+        if self.tracing(SUMMARY):
+            self.trace.write("\nAFTER TRAINING\n---------------------\n")
+            self.trace.write(self.strStateInfo())
+        return history
 
 
 if __name__ == "__main__":  
     
-    model = HMM(corpus=["babi#", "dida#"], out_path="sample_log.txt")
-    model.setCorpusSoftCounts(verboseFlag=True)
\ No newline at end of file
+    with HMM(corpus=["babi#", "dida#"], out_path="sample_log.txt") as model:
+        model.setCorpusSoftCounts(verboseFlag=True)
\ No newline at end of file
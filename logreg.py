@@ -2,77 +2,283 @@
 #simple Logistic Regression class with gradient checking
 import numpy as np
 from numpy.linalg import norm
-import pickle, gzip
+from activations import ACTIVATIONS
+from checkpoint import saveArrays, loadArrays
+from gradcheck import checkGradient
+from optimizers import SGD, lbfgs
+from mnistdata import loadMnist, oneHot, randomBatch, stackColumns
+from sparsedata import dotDense, sparseOuter, takeRows
+
+def logSumExp(z):
+    """log(sum(exp(z))) over each column, without overflow"""
+    zmax = np.max(z, axis=0)
+    return zmax + np.log(np.sum(np.exp(z - zmax), axis=0))
 
 class LogisticRegression():
     """
-    Logistic regression, trained by gradient descent
+    Logistic regression, trained by gradient descent, or to convergence by
+    fit. With multinomial=True the outputs are one softmax instead of
+    independent sigmoids.
     """    
-    def __init__(self, nin, nout):
+    def __init__(self, nin, nout, multinomial=False):
         #adding one row for bias        
         self.theta = np.random.uniform(-1, 1, (nout, nin+1))
-        #activation function        
-        self.activ = lambda x: 1 / (1.0 + np.exp(-x))
-        self.activprime = lambda x: self.activ(x) * (1 - self.activ(x))
+        self.multinomial = multinomial
+        #activation function; activprime takes its output, not its input
+        self.activ = ACTIVATIONS["softmax" if multinomial else "sigmoid"]
+        self.activprime = self.activ.derivative
+        self.optimizer = None #kept between partial_fit calls
         
     
     def single_gradient(self, X, y):
         """Calculates gradient of theta for a single datapoint"""
-        ypred = self.predict(X)
-        Xbias = np.vstack((X, np.array([1.0])))
-        delta = (ypred - y)                
-        return np.dot(delta, Xbias.T)
+        return self.batch_gradient(X, y)
+
+    def batch_gradient(self, X, y, ypred=None):
+        """Gradient of theta averaged over datapoints stacked as columns of
+        X and y. The weight and bias parts are computed separately, with
+        one matrix product for the whole batch."""
+        m = X.shape[1]
+        if ypred is None:
+            ypred = self.predict(X)
+        delta = ypred - y
+        grad = np.empty_like(self.theta)
+        grad[:, :-1] = np.dot(delta, X.T)
+        grad[:, -1] = np.sum(delta, axis=1)
+        grad /= m
+        return grad
         
     
-    def train(self, Xtrain, ytrain, niter, alpha, batchsize=100):
+    def train(self, Xtrain, ytrain, niter, alpha, batchsize=100,
+              evalevery=10, evalset=None, evalsize=1000, optimizer=None):
+        """Every evalevery iterations (never if 0) the error is printed,
+        measured on evalset=(Xs, ys) if given, otherwise on a fixed random
+        subset of evalsize training points.
+        Xtrain, ytrain are lists of column vectors, or arrays with one
+        datapoint per row (e.g. memmaps from loadMnist) and integer or
+        one-hot labels.
+        optimizer is one from optimizers.py, by default SGD(alpha)."""
+        if optimizer is None:
+            optimizer = SGD(alpha)
+        nout = self.theta.shape[0]
+        if evalevery:
+            if evalset is None:
+                Xeval, yeval = randomBatch(Xtrain, ytrain, min(evalsize, len(Xtrain)),
+                                           nout, replace=False)
+            else:
+                Xeval, yeval = stackColumns(evalset[0], evalset[1], nout)
         for t in range(niter):        
-            total_gradient = 0        
-            batchidx = np.random.choice(range(len(Xtrain)), batchsize)
-            Xbatch = [Xtrain[i] for i in batchidx]
-            ybatch = [ytrain[i] for i in batchidx] 
-            for i in range(len(Xbatch)):
-                X,y = Xbatch[i],ybatch[i]
-                total_gradient -= self.single_gradient(X,y)
-                #total_gradient += self.numerical_gradient(X, y)
-            total_gradient /= len(Xbatch)           
-            self.theta += alpha * total_gradient
-            if t%10==0:            
+            Xbatch, ybatch = randomBatch(Xtrain, ytrain, batchsize, nout)
+            total_gradient = self.batch_gradient(Xbatch, ybatch)
+            np.negative(total_gradient, out=total_gradient)
+            optimizer.step([self.theta], [total_gradient])
+            if evalevery and t%evalevery==0:
                 print("Iteration {0}, error: {1}".format(
-                    t, self.error(Xtrain, ytrain)))
+                    t, self.batch_error(Xeval, yeval)))
             
     
+    def partial_fit(self, X, y, alpha=0.15, optimizer=None):
+        """One gradient step on a chunk with one datapoint per row and
+        integer or one-hot labels, for data that doesn't fit in memory
+        (see streaming.streamTrain). The optimizer, SGD(alpha) unless
+        given, is kept for the following calls."""
+        if optimizer is not None:
+            self.optimizer = optimizer
+        elif self.optimizer is None:
+            self.optimizer = SGD(alpha)
+        X, y = stackColumns(X, y, self.theta.shape[0])
+        total_gradient = self.batch_gradient(X, y)
+        np.negative(total_gradient, out=total_gradient)
+        self.optimizer.step([self.theta], [total_gradient])
+
     def predict(self, X):
-        X = np.vstack((X, np.array([1.0]))) #add bias input
-        return self.activ(np.dot(self.theta, X))
+        """Predicts for a column vector, or datapoints stacked as columns.
+        The last column of theta is the bias, added without stacking a row
+        of ones onto X."""
+        return self.activ(np.dot(self.theta[:, :-1], X) + self.theta[:, -1:])
+
+    def predict_batch(self, Xs, chunksize=1024):
+        """Predicts for an (n_samples, nin) array, chunksize rows at a time
+        to bound memory. The bias column is added by a separate product
+        instead of stacking it onto the inputs.
+        Returns (predictions, labels); labels are the argmax of each row."""
+        Xs = np.asarray(Xs)
+        W, b = self.theta[:, :-1], self.theta[:, -1]
+        preds = np.empty((Xs.shape[0], self.theta.shape[0]))
+        for start in range(0, Xs.shape[0], chunksize):
+            chunk = Xs[start:start+chunksize]
+            #activ works on columns, softmax normalizes each of them
+            preds[start:start+chunksize] = self.activ((np.dot(chunk, W.T) + b).T).T
+        return preds, np.argmax(preds, axis=1)
     
+    def sparse_predict(self, X):
+        """Predicts for a CSR matrix (sparsedata.py or scipy.sparse) with
+        one datapoint per row; returns (predictions, labels) as
+        predict_batch does. Cost scales with the nonzeros of X."""
+        z = dotDense(X, self.theta[:, :-1]) + self.theta[:, -1]
+        preds = self.activ(z.T).T
+        return preds, np.argmax(preds, axis=1)
+
+    def sparse_step(self, X, y, alpha):
+        """One gradient descent step on a CSR batch with one datapoint per
+        row and integer or one-hot labels. Only the weights of features
+        active in the batch, and the bias, are touched."""
+        m = X.shape[0]
+        if y.ndim == 1:
+            y = oneHot(y, self.theta.shape[0]).T
+        delta = self.sparse_predict(X)[0] - y
+        cols, G = sparseOuter(delta, X)
+        self.theta[:, cols] -= (alpha / m) * G
+        self.theta[:, -1] -= (alpha / m) * np.sum(delta, axis=0)
+
+    def train_sparse(self, Xtrain, ytrain, niter, alpha, batchsize=100):
+        """Mini-batch training on a CSR matrix Xtrain, one datapoint per
+        row; memory and time per step scale with the nonzeros of a batch"""
+        ytrain = np.asarray(ytrain)
+        for t in range(niter):
+            batchidx = np.random.randint(0, Xtrain.shape[0], size=batchsize)
+            self.sparse_step(takeRows(Xtrain, batchidx), ytrain[batchidx], alpha)
+
     def error(self, Xs, ys):
         """Computes preditction error for a dataset.
             Uses a convex cost function."""        
-        m = len(Xs)        
-        ypreds = list(map(self.predict, Xs))
-        errs = [ys[i]*np.log(ypreds[i]) + (1-ys[i])*np.log(1-ypreds[i]) for i in range(len(ys))]         
-        total = sum(map(norm, errs))
-        #diffs = sum([np.dot((ys[i]-ypreds[i]).T, (ys[i]-ypreds[i])) for i in range(len(ys))])
+        return self.batch_error(np.hstack(Xs), np.hstack(ys))
+
+    def batch_error(self, X, y):
+        """Same as error, for datapoints stacked as columns of X and y. With
+        multinomial=True it is the softmax cross-entropy that is minimized.
+        Both are computed from the logits, so saturated outputs stay finite."""
+        m = X.shape[1]
+        z = np.dot(self.theta[:, :-1], X) + self.theta[:, -1:]
+        if self.multinomial:
+            return np.sum(logSumExp(z) - np.sum(y*z, axis=0)) / m
+        errs = y*z - np.logaddexp(0, z) #y*log(p) + (1-y)*log(1-p)
+        total = np.sum(norm(errs, axis=0))
         return -1.0/(m) * total
     
     def numerical_gradient(self, X, y, eps=0.000001):
         """
             Gradient computed by numerical approximation.
-            For gradient checking.
+            Perturbs every weight in turn; check_gradient samples instead.
         """
-        saved_theta = self.theta[:] #copy
         theta = self.theta
         grad = np.zeros(theta.shape)
         for i in range(theta.shape[0]):
             for j in range(theta.shape[1]):
-                self.theta[i][j] += eps
+                saved = theta[i][j]
+                theta[i][j] = saved + eps
                 high = self.error([X],[y])
-                self.theta[i][j] -= 2*eps
+                theta[i][j] = saved - eps
                 low = self.error([X],[y])
-                dWij = (high - low) / (2*eps)
-                grad[i][j] = dWij
-                self.theta = saved_theta #restore the values
+                theta[i][j] = saved #restore the value
+                grad[i][j] = (high - low) / (2*eps)
         return grad
+
+    def loss_and_gradient(self, X, y, l2=0.0):
+        """Mean cross-entropy of datapoints stacked as columns of X and y,
+        plus l2/2 times the squared weights (not the bias), and its
+        gradient. Computed from the logits, with log-sum-exp for softmax,
+        so saturated outputs stay exact."""
+        m = X.shape[1]
+        z = np.dot(self.theta[:, :-1], X) + self.theta[:, -1:]
+        if self.multinomial:
+            lse = logSumExp(z)
+            loss = np.sum(lse - np.sum(y*z, axis=0)) / m
+            ypred = np.exp(z - lse)
+        else:
+            loss = np.sum(np.logaddexp(0, z) - y*z) / m
+            ypred = self.activ(z)
+        W = self.theta[:, :-1]
+        loss += 0.5 * l2 * np.sum(W*W)
+        grad = self.batch_gradient(X, y, ypred)
+        grad[:, :-1] += l2 * W
+        return loss, grad
+
+    def newton_step(self, X, grad, l2=0.0):
+        """Solves H step = grad for the Hessian H of loss_and_gradient.
+        Independent sigmoids give one (nin+1)x(nin+1) system per output;
+        softmax couples the outputs into one system nout times larger."""
+        m = X.shape[1]
+        nout, D = self.theta.shape
+        Xb = np.vstack((X, np.ones((1, m)))) #once per step, not per datapoint
+        P = self.predict(X)
+        #l2 on the weights, and a little damping so the bias part is
+        #solvable too (softmax is invariant to shifting all logits)
+        reg = np.append(np.full(D-1, l2), 0.0) + 1e-8
+        if not self.multinomial:
+            step = np.empty_like(grad)
+            for k in range(nout):
+                H = np.dot(Xb * (P[k]*(1-P[k])), Xb.T) / m + np.diag(reg)
+                step[k] = np.linalg.solve(H, grad[k])
+            return step
+        H = np.empty((nout*D, nout*D))
+        for k in range(nout):
+            for l in range(nout):
+                w = P[k] * ((k == l) - P[l])
+                H[k*D:(k+1)*D, l*D:(l+1)*D] = np.dot(Xb * w, Xb.T) / m
+        H += np.diag(np.tile(reg, nout))
+        return np.linalg.solve(H, grad.ravel()).reshape(grad.shape)
+
+    def fit(self, Xtrain, ytrain, solver="lbfgs", l2=0.0, maxiter=100, tol=1e-8):
+        """Full-batch training to convergence, from theta = 0, so results
+        are deterministic. solver is "lbfgs", or "newton" (IRLS) for small
+        nin. Data is given as for train."""
+        nout = self.theta.shape[0]
+        X, y = stackColumns(Xtrain, ytrain, nout)
+        X = np.asarray(X, dtype=np.float64)
+        self.theta = np.zeros(self.theta.shape)
+        if solver == "lbfgs":
+            shape = self.theta.shape
+            def f(flat):
+                self.theta = flat.reshape(shape)
+                loss, grad = self.loss_and_gradient(X, y, l2)
+                return loss, grad.ravel()
+            flat, niter = lbfgs(f, self.theta.ravel(), maxiter, tol)
+            self.theta = flat.reshape(shape)
+        elif solver == "newton":
+            loss, grad = self.loss_and_gradient(X, y, l2)
+            for niter in range(1, maxiter+1):
+                step = self.newton_step(X, grad, l2)
+                #halve the step until the loss decreases
+                theta = self.theta
+                rate = 1.0
+                while True:
+                    self.theta = theta - rate*step
+                    newloss, newgrad = self.loss_and_gradient(X, y, l2)
+                    if newloss <= loss or rate < 1e-10:
+                        break
+                    rate *= 0.5
+                converged = loss - newloss <= tol*max(1.0, abs(loss))
+                loss, grad = newloss, newgrad
+                if converged:
+                    break
+        else:
+            raise ValueError("Unknown solver {0}".format(solver))
+        print("{0} stopped after {1} iterations, loss: {2}".format(
+            solver, niter, self.loss_and_gradient(X, y, l2)[0]))
+
+    def check_gradient(self, X, y, ndirections=5, ncoords=20, eps=1e-6):
+        """Compares the batch gradient on the columns of X, y with central
+        differences of the cross-entropy along random directions and at
+        random coordinates of theta. Returns the largest relative error."""
+        grad = self.batch_gradient(X, y)
+        loss = lambda: self.loss_and_gradient(X, y)[0]
+        return checkGradient([self.theta], loss, [grad], ndirections, ncoords, eps)
+
+    def save(self, path):
+        """Writes a checkpoint directory (see checkpoint.py)"""
+        nout, nin = self.theta.shape[0], self.theta.shape[1] - 1
+        meta = {"nin": nin, "nout": nout, "multinomial": self.multinomial}
+        saveArrays(path, "LogisticRegression", meta, [self.theta])
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Loads a checkpoint written by save. By default theta is a
+        read-only memmap, for scoring; pass mmap_mode='c' or None to train."""
+        meta, arrays = loadArrays(path, "LogisticRegression", mmap_mode)
+        model = cls(meta["nin"], meta["nout"], meta["multinomial"])
+        model.theta = arrays[0]
+        return model
     
 
 def test():
@@ -96,24 +302,15 @@ def testMnist(to_test):
     #pickled MNIST dataset from deeplearning.net    
     global train_set, valid_set
     global model
-    f = gzip.open('mnist.pkl.gz', 'rb')
-    train_set, valid_set, test_set = pickle.load(f, encoding='latin1')
-    f.close()    
-    Xs = list(map(lambda arr: np.array(arr).reshape(784,1), train_set[0]))
-    ys = list(map(lambda n: np.array([1 if i==n else 0 for i in range(10)]).reshape(10,1), train_set[1]))
+    train_set, valid_set, test_set = loadMnist()
+    Xs, ys = train_set
     model = LogisticRegression(784, 10)
     model.train(Xs, ys, 1000, 0.15)
-    correct = 0
-    for i in range(to_test):
-        pred = np.argmax(model.predict(test_set[0][i].reshape(784,1)))
-        actual = test_set[1][i]
-        msg = "INCORRECT"        
-        if actual == pred:        
-            msg = "CORRECT"
-            correct += 1
-        #print("Number: {0}. Predicted: {1}. {2}".format(actual, pred, msg))
+    _, preds = model.predict_batch(test_set[0][:to_test])
+    correct = np.sum(preds == test_set[1][:to_test])
     print("Accuracy: {0}".format(correct*1.0/to_test))
         
         
-np.random.seed(1)
-testMnist(10000)
\ No newline at end of file
+if __name__ == "__main__":
+    np.random.seed(1)
+    testMnist(10000)
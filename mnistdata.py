@@ -0,0 +1,81 @@
+# MNIST in a contiguous, memory-mappable format
+# Shared by logreg.py and neuralnet-bias.py: the pickle is converted once to
+# float32 .npy files with integer labels, which then load as memmaps
+
+import os
+import pickle, gzip
+import numpy as np
+
+SPLITS = ["train", "valid", "test"]
+
+
+def convertMnist(pkl_path="mnist.pkl.gz", out_dir="mnist_npy"):
+    """Unpickles the deeplearning.net dataset and writes every split as
+    <split>_X.npy (float32, one image per row) and <split>_y.npy (labels)"""
+    f = gzip.open(pkl_path, 'rb')
+    sets = pickle.load(f, encoding='latin1')
+    f.close()
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    for name, (X, y) in zip(SPLITS, sets):
+        np.save(os.path.join(out_dir, name + "_X.npy"),
+                np.ascontiguousarray(X, dtype=np.float32))
+        np.save(os.path.join(out_dir, name + "_y.npy"), np.asarray(y, dtype=np.int64))
+
+
+def loadMnist(out_dir="mnist_npy", pkl_path="mnist.pkl.gz"):
+    """Returns train, valid and test sets as (X, y) pairs of read-only
+    memmaps, converting the pickle first if needed. Processes loading the
+    same files share one copy in the page cache."""
+    if not os.path.exists(os.path.join(out_dir, "test_y.npy")):
+        convertMnist(pkl_path, out_dir)
+    return [(np.load(os.path.join(out_dir, name + "_X.npy"), mmap_mode='r'),
+             np.load(os.path.join(out_dir, name + "_y.npy"), mmap_mode='r'))
+            for name in SPLITS]
+
+
+def oneHot(labels, n):
+    """Integer labels as one-hot columns, shape (n, len(labels))"""
+    return np.eye(n)[:, np.asarray(labels)]
+
+
+def stackColumns(Xs, ys, nout):
+    """Turns a dataset into (features, m) and (nout, m) matrices with one
+    datapoint per column. Accepts lists of column vectors, or arrays with
+    one datapoint per row and either integer or one-hot labels."""
+    if isinstance(Xs, np.ndarray):
+        X = Xs.T
+    else:
+        X = np.hstack(Xs)
+    if isinstance(ys, np.ndarray) and ys.ndim == 1:
+        y = oneHot(ys, nout)
+    elif isinstance(ys, np.ndarray):
+        y = ys.T
+    else:
+        y = np.hstack(ys)
+    return X, y
+
+
+def take(Xs, idx):
+    """Selects datapoints by index; on a memmap only those rows are read"""
+    if isinstance(Xs, np.ndarray):
+        return Xs[idx]
+    return [Xs[i] for i in idx]
+
+
+def randomBatch(Xs, ys, batchsize, nout, replace=True):
+    """Random batch of datapoints, stacked as columns"""
+    idx = np.random.choice(len(Xs), batchsize, replace=replace)
+    return stackColumns(take(Xs, idx), take(ys, idx), nout)
+
+
+def syntheticMnist(n, nin=784, nout=10, seed=0):
+    """n images of nin float32 pixels in [0, 1] with labels in range(nout).
+    Each class brightens its own block of pixels, so the task is learnable."""
+    rng = np.random.RandomState(seed)
+    y = rng.randint(0, nout, n)
+    X = rng.uniform(0, 0.5, (n, nin)).astype(np.float32)
+    block = nin // nout
+    for k in range(nout):
+        X[y == k, k*block:(k+1)*block] += 0.5
+    return X, y
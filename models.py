@@ -0,0 +1,17 @@
+# Loading of the learner scripts by path, for the tools that drive them
+# (benchmark.py, sweep.py, serve.py). neuralnet-bias.py is not a valid
+# module name, so it cannot be imported with an import statement.
+
+import importlib.util
+import os
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def loadModule(name, filename):
+    """Imports a script by path; neuralnet-bias.py is not a valid module
+    name. Its testMnist only runs under __main__, so nothing is trained."""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(HERE, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
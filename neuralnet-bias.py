@@ -2,25 +2,47 @@
 # Neural network algorithm with backpropagation
 
 import numpy as np
-import pickle, gzip
+import multiprocessing as mp
+from activations import getActivation
+from checkpoint import saveArrays, loadArrays
+from gradcheck import checkGradient
+from optimizers import SGD
+from mnistdata import loadMnist, randomBatch, stackColumns, take
+
+def sharedBuffer(ctx, shape, dtype):
+    """Zeroed array in shared memory, visible to forked processes"""
+    raw = ctx.RawArray('b', int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+def unflatten(flat, shapes):
+    """Splits a flat array into views of the given shapes"""
+    views = []
+    start = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        views.append(flat[start:start+size].reshape(shape))
+        start += size
+    return views
 
 class NN():
-    def __init__(self, nlayers, sizes, g=None, dg=None):
+    def __init__(self, nlayers, sizes, g=None, dg=None, dtype=np.float64):
         self.nlayers = nlayers #first one is the input, last one is the output
         self.sizes = sizes #array of int sizes
+        self.dtype = dtype #of weights, and data is converted to it in training
         self.thetas = []
         self.biases = []
         for i in range(nlayers-1):
             shape = (sizes[i+1], sizes[i])            
-            self.thetas.append(np.random.uniform(-0.5, 0.5, size=shape))
-            self.biases.append(np.random.uniform(-0.5,0.5, size=(sizes[i+1], 1)))
-        #g is the nonlinear activation function; dg its derivative
-        if g==None:
-            self.g = lambda x: 1 / (1.0 + np.exp(-x))
-            self.dg = lambda x: self.g(x) * (1 - self.g(x))
-        else:
-            self.g = g
-            self.dg=dg
+            self.thetas.append(np.random.uniform(-0.5, 0.5, size=shape).astype(dtype))
+            self.biases.append(np.random.uniform(-0.5,0.5, size=(sizes[i+1], 1)).astype(dtype))
+        self.buffers = {} #work arrays for gradients, by batch size
+        self.optimizer = None #kept between partial_fit calls
+        #g is the nonlinear activation function: None for sigmoid, a name
+        #from activations.ACTIVATIONS, or a function with dg its derivative
+        #in terms of the output of g
+        self.activation = getActivation(g, dg)
+        self.g = self.activation
+        self.dg = self.activation.derivative
             
     
     def forward(self, X):
@@ -28,74 +50,255 @@ class NN():
         for i in range(self.nlayers-1):
             a = self.g(np.dot(self.thetas[i], a) + self.biases[i])
         return a
+
+    def forward_batch(self, Xs, chunksize=1024):
+        """Runs forward on an (n_samples, features) array, chunksize rows
+        at a time to bound memory. Returns (outputs, labels), where outputs
+        is (n_samples, nout) and labels is the argmax of each row."""
+        Xs = np.asarray(Xs)
+        outputs = np.empty((Xs.shape[0], self.sizes[-1]))
+        for start in range(0, Xs.shape[0], chunksize):
+            chunk = Xs[start:start+chunksize]
+            outputs[start:start+chunksize] = self.forward(chunk.T).T
+        return outputs, np.argmax(outputs, axis=1)
     
-    def train(self, Xtrain, ytrain, alpha, niter):
-        print("Learning with alpha = {0}".format(alpha))        
+    def train(self, Xtrain, ytrain, alpha, niter, batchsize=1,
+              evalevery=10, evalset=None, evalsize=1000, optimizer=None):
+        """Trains by mini-batch gradient descent. Each step stacks batchsize
+        datapoints as columns of one matrix and pushes it through forward
+        and backprop at once; gradients are averaged over the batch.
+        Every evalevery iterations (never if 0) the L2 error is printed,
+        measured on evalset=(Xs, ys) if given, otherwise on a fixed random
+        subset of evalsize training points.
+        Xtrain, ytrain are lists of column vectors, or arrays with one
+        datapoint per row (e.g. memmaps from loadMnist) and integer or
+        one-hot labels.
+        optimizer is one from optimizers.py, by default SGD(alpha)."""
+        if optimizer is None:
+            optimizer = SGD(alpha)
+        print("Learning with {0}, alpha = {1}, batchsize = {2}".format(
+            type(optimizer).__name__, optimizer.alpha, batchsize))
         self.biases = list(map(lambda x: x*0, self.biases)) #TOCHANGE
         print(self.biases)
+        nout = self.sizes[-1]
+        if evalevery:
+            if evalset is None:
+                Xeval, yeval = randomBatch(Xtrain, ytrain, min(evalsize, len(Xtrain)),
+                                           nout, replace=False)
+            else:
+                Xeval, yeval = stackColumns(evalset[0], evalset[1], nout)
         for t in range(niter):        
-            #pick one datapoint        
-            i = np.random.randint(0, len(Xtrain))
-            X = Xtrain[i]
-            y = ytrain[i]
-            #compute ypred saving outputs for all hidden layers
-            results = [X] #"outputs" in the input layer, for nicer indexing
-            a = X        
-            for i in range(self.nlayers-1):
-                a = self.g(np.dot(self.thetas[i], a) + self.biases[i])
-                results.append(a)
-            ypred = a[-1]
-            deltas = [None for _ in range(self.nlayers)]
-            #we compute deltas, which are errors propagated backwards        
-            #deltas[0] should stay None, because we don't compute errors for inputs
-            deltas[self.nlayers-1] = (y-ypred) * self.dg(ypred)
-            #deltas[self.nlayers-1] = (y-ypred)
-            for i in range(self.nlayers-2, 0, -1):
-                deltas[i] = np.dot(self.thetas[i].T, deltas[i+1]) \
-                    * self.dg(results[i])
-            #now we compute changes in weights, theta is exterior product
-            #of outputs from source layer and deltas of target layer
-            delta_thetas = []
-#            numerical = self.numerical_gradient(X,y)
-            for i in range(self.nlayers-1):
-                delta_thetas.append(np.dot(deltas[i+1], results[i].T))
-                #update weights by deltas * learning rate            
-                self.thetas[i] += alpha * delta_thetas[i]
-                self.biases[i] += alpha * deltas[i+1]
-                #self.thetas[i] -= alpha * numerical[i]
-#                print(delta_thetas)
-#                print(self.numerical_gradient(X,y))
-#                print("---")
+            #pick a mini-batch of datapoints, one per column
+            X, y = randomBatch(Xtrain, ytrain, batchsize, nout)
+            delta_thetas, delta_biases = self.gradients(X, y)
+            optimizer.step(self.thetas + self.biases, delta_thetas + delta_biases)
                 
-            if t%10==0:
-                error = 0                
-                for i in range(len(Xtrain)):
-                    error += np.linalg.norm(self.forward(Xtrain[i]) - ytrain[i])
-                error /= len(Xtrain)
+            if evalevery and t%evalevery==0:
+                error = self.batch_error(Xeval, yeval)
                 print("Iteration {0}: L2 error {1}".format(t, error))
-        print("Iteration {0}: L2 error {1}".format(t, error))
+        if evalevery:
+            print("Iteration {0}: L2 error {1}".format(t, self.batch_error(Xeval, yeval)))
         
+    def work_arrays(self, m):
+        """Per-layer activations, deltas and temporaries for batches of m
+        columns, plus gradient arrays; allocated once per batch size"""
+        if m not in self.buffers:
+            shapes = [(size, m) for size in self.sizes[1:]]
+            self.buffers[m] = ([np.empty(shape, self.dtype) for shape in shapes],
+                               [np.empty(shape, self.dtype) for shape in shapes],
+                               [np.empty(shape, self.dtype) for shape in shapes],
+                               [np.empty_like(theta) for theta in self.thetas],
+                               [np.empty_like(bias) for bias in self.biases])
+        return self.buffers[m]
+
+    def partial_fit(self, X, y, alpha=0.1, optimizer=None):
+        """One gradient step on a chunk with one datapoint per row and
+        integer or one-hot labels, for data that doesn't fit in memory
+        (see streaming.streamTrain). The optimizer, SGD(alpha) unless
+        given, is kept for the following calls."""
+        if optimizer is not None:
+            self.optimizer = optimizer
+        elif self.optimizer is None:
+            self.optimizer = SGD(alpha)
+        X, y = stackColumns(X, y, self.sizes[-1])
+        delta_thetas, delta_biases = self.gradients(X, y)
+        self.optimizer.step(self.thetas + self.biases, delta_thetas + delta_biases)
+
+    def gradients(self, X, y):
+        """Backprop for datapoints stacked as columns of X and y. Returns
+        the changes of thetas and biases that decrease the error, averaged
+        over the columns. Works in preallocated arrays: the results are
+        overwritten by the next call with the same batch size."""
+        m = X.shape[1]
+        activations, deltas, tmps, delta_thetas, delta_biases = self.work_arrays(m)
+        X = X.astype(self.dtype, copy=False)
+        #compute ypred saving outputs for all hidden layers
+        results = [X] + activations #"outputs" in the input layer, for nicer indexing
+        for i in range(self.nlayers-1):
+            np.dot(self.thetas[i], results[i], out=results[i+1])
+            results[i+1] += self.biases[i]
+            self.activation(results[i+1], out=results[i+1])
+        ypred = results[-1]
+        #we compute deltas, which are errors propagated backwards        
+        #deltas[0] is None, because we don't compute errors for inputs
+        deltas = [None] + deltas
+        tmps = [None] + tmps
+        np.subtract(y, ypred, out=deltas[-1])
+        self.activation.backprop(deltas[-1], ypred, tmps[-1])
+        for i in range(self.nlayers-2, 0, -1):
+            np.dot(self.thetas[i].T, deltas[i+1], out=deltas[i])
+            self.activation.backprop(deltas[i], results[i], tmps[i])
+        #now we compute changes in weights; summing the exterior products
+        #over the batch is a single matrix product, then we average
+        for i in range(self.nlayers-1):
+            np.dot(deltas[i+1], results[i].T, out=delta_thetas[i])
+            delta_thetas[i] /= m
+            np.sum(deltas[i+1], axis=1, keepdims=True, out=delta_biases[i])
+            delta_biases[i] /= m
+        return delta_thetas, delta_biases
+
+    def step(self, alpha, delta_thetas, delta_biases):
+        """Updates weights in place by deltas * learning rate; the deltas
+        are scaled in place too"""
+        for i in range(self.nlayers-1):
+            delta_thetas[i] *= alpha
+            self.thetas[i] += delta_thetas[i]
+            delta_biases[i] *= alpha
+            self.biases[i] += delta_biases[i]
+
+    def share_weights(self, ctx):
+        """Moves thetas and biases into one flat shared-memory array, which
+        is returned; the attributes become views into it"""
+        params = self.thetas + self.biases
+        flat = sharedBuffer(ctx, (sum(p.size for p in params),), params[0].dtype)
+        views = unflatten(flat, [p.shape for p in params])
+        for view, p in zip(views, params):
+            view[...] = p
+        self.thetas, self.biases = views[:self.nlayers-1], views[self.nlayers-1:]
+        return flat
+
+    def train_parallel(self, Xtrain, ytrain, alpha, niter, batchsize=10,
+                       nworkers=None, mode="async", evalsize=1000, timeout=600):
+        """Data-parallel training with nworkers processes (default: one per
+        core), each on its own shard of the data. Weights live in shared
+        memory.
+        mode="async": workers update the weights without locking (Hogwild),
+        niter steps in total.
+        mode="sync": every step each worker computes a gradient on its own
+        batch and the average is applied once, for niter steps.
+        If a sync worker fails, or waits more than timeout seconds for the
+        others, the barrier is broken and all of them stop.
+        Workers are forked, since g and dg may be lambdas. Limit BLAS to one
+        thread per process (e.g. OMP_NUM_THREADS=1) to scale with cores."""
+        if nworkers is None:
+            nworkers = mp.cpu_count()
+        if mode not in ("async", "sync"):
+            raise ValueError("Unknown mode {0}".format(mode))
+        ctx = mp.get_context("fork")
+        nout = self.sizes[-1]
+        flat = self.share_weights(ctx)
+        shards = np.array_split(np.random.permutation(len(Xtrain)), nworkers)
+        seeds = np.random.randint(0, 2**31, size=nworkers)
+        grads = sharedBuffer(ctx, (nworkers, flat.size), flat.dtype)
+        barrier = ctx.Barrier(nworkers)
+        print("Learning with alpha = {0}, batchsize = {1}, {2} {3} workers".format(
+            alpha, batchsize, nworkers, mode))
+
+        def work(w):
+            try:
+                run(w)
+            except BaseException:
+                barrier.abort() #wake up the other workers instead of leaving them waiting
+                raise
+
+        def run(w):
+            np.random.seed(seeds[w])
+            shard = shards[w]
+            mygrads = unflatten(grads[w], [p.shape for p in self.thetas + self.biases])
+            steps = range(w, niter, nworkers) if mode == "async" else range(niter)
+            for t in steps:
+                idx = shard[np.random.randint(0, len(shard), size=batchsize)]
+                X, y = stackColumns(take(Xtrain, idx), take(ytrain, idx), nout)
+                delta_thetas, delta_biases = self.gradients(X, y)
+                if mode == "async":
+                    self.step(alpha, delta_thetas, delta_biases)
+                else:
+                    for view, delta in zip(mygrads, delta_thetas + delta_biases):
+                        view[...] = delta
+                    barrier.wait(timeout)
+                    if w == 0:
+                        flat[:] += alpha * np.mean(grads, axis=0)
+                    barrier.wait(timeout)
+
+        procs = [ctx.Process(target=work, args=(w,)) for w in range(nworkers)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        if any(proc.exitcode != 0 for proc in procs):
+            raise RuntimeError("Training worker failed")
+        Xeval, yeval = randomBatch(Xtrain, ytrain, min(evalsize, len(Xtrain)),
+                                   nout, replace=False)
+        print("Final L2 error {0}".format(self.batch_error(Xeval, yeval)))
+
     def single_error(self, X, y):
         error = np.linalg.norm(self.forward(X) - y)
         return error
+
+    def batch_error(self, X, y):
+        """Mean L2 error over datapoints stacked as columns of X and y"""
+        return np.mean(np.linalg.norm(self.forward(X) - y, axis=0))
     
     def numerical_gradient(self, X, y, eps=0.000001):
+        """Gradient of single_error by perturbing every weight in turn.
+        Slow; check_gradient samples instead."""
         gradients = []
-        saved_thetas = self.thetas[:] #copy
         for l in range(self.nlayers-1):
             theta = self.thetas[l]
             grad = np.zeros(theta.shape)
             for i in range(theta.shape[0]):
                 for j in range(theta.shape[1]):
-                    self.thetas[l][i][j] += eps
+                    saved = theta[i][j]
+                    theta[i][j] = saved + eps
                     high = self.single_error(X,y)
-                    self.thetas[l][i][j] -= 2*eps
+                    theta[i][j] = saved - eps
                     low = self.single_error(X,y)
-                    dWij = (high - low) / (2*eps)
-                    grad[i][j] = dWij
-                    self.thetas = saved_thetas #restore the values
+                    theta[i][j] = saved #restore the value
+                    grad[i][j] = (high - low) / (2*eps)
             gradients.append(grad)
         return gradients
+
+    def check_gradient(self, X, y, ndirections=5, ncoords=20, eps=1e-6):
+        """Compares gradients on the columns of X, y with central
+        differences along random directions and at random coordinates of
+        thetas and biases. Returns the largest relative error; use float64
+        weights, float32 is too coarse for the differences."""
+        m = X.shape[1]
+        delta_thetas, delta_biases = self.gradients(X, y)
+        #gradients are descent directions of half the mean squared error
+        grads = [-d for d in delta_thetas + delta_biases]
+        loss = lambda: 0.5 * np.sum((self.forward(X) - y)**2) / m
+        return checkGradient(self.thetas + self.biases, loss, grads,
+                             ndirections, ncoords, eps)
+
+    def save(self, path):
+        """Writes a checkpoint directory (see checkpoint.py)"""
+        if self.activation.name == "custom":
+            raise ValueError("Only activations from activations.ACTIVATIONS can be saved")
+        meta = {"nlayers": self.nlayers, "sizes": list(self.sizes),
+                "activation": self.activation.name}
+        saveArrays(path, "NN", meta, self.thetas + self.biases)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Loads a checkpoint written by save. By default the weights are a
+        read-only memmap, for scoring; pass mmap_mode='c' or None to train."""
+        meta, arrays = loadArrays(path, "NN", mmap_mode)
+        net = cls(meta["nlayers"], meta["sizes"], g=meta["activation"],
+                  dtype=arrays[0].dtype)
+        net.thetas = arrays[:net.nlayers-1]
+        net.biases = arrays[net.nlayers-1:]
+        return net
                 
                 
                 
@@ -123,28 +326,20 @@ def testMnist(to_test):
     #pickled MNIST dataset from deeplearning.net    
     global train_set, valid_set
     global model
-    f = gzip.open('mnist.pkl.gz', 'rb')
-    train_set, valid_set, test_set = pickle.load(f, encoding='latin1')
-    f.close()    
-    Xs = list(map(lambda arr: np.array(arr).reshape(784,1), train_set[0]))
-    ys = list(map(lambda n: np.array([1 if i==n else 0 for i in range(10)]).reshape(10,1), train_set[1]))
-    model = NN(3,[784, 50, 10])
+    train_set, valid_set, test_set = loadMnist()
+    Xs, ys = train_set
+    model = NN(3,[784, 50, 10], dtype=np.float32)
     model.train(Xs, ys, 0.1, 300)
-    correct = 0
-    for i in range(to_test):
-        pred = np.argmax(model.forward(test_set[0][i].reshape(784,1)))
-        actual = test_set[1][i]
-        msg = "INCORRECT"        
-        if actual == pred:        
-            msg = "CORRECT"
-            correct += 1
-        #print("Number: {0}. Predicted: {1}. {2}".format(actual, pred, msg))
+    _, preds = model.forward_batch(test_set[0][:to_test])
+    correct = np.sum(preds == test_set[1][:to_test])
     print("Accuracy: {0}".format(correct*1.0/to_test))
 
-np.random.seed(1)
-#testLogic()
-#testLinear()
-testMnist(1000)
+if __name__ == "__main__":
+    np.random.seed(1)
+    #testLogic()
+    #testLinear()
+    testMnist(1000)
+
 
 
 
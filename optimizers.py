@@ -0,0 +1,186 @@
+# Optimizers and learning rate schedules for logreg.py and neuralnet-bias.py
+# An optimizer updates a list of weight arrays in place from a list of
+# deltas, the descent directions (minus the gradient) that the learners
+# compute. Its state is allocated once, on the first step, and the deltas
+# are used as scratch space.
+
+import numpy as np
+
+
+def constant():
+    return lambda t: 1.0
+
+def stepDecay(every, factor=0.5):
+    """Multiplies the rate by factor every `every` steps"""
+    return lambda t: factor ** (t // every)
+
+def cosine(total, floor=0.0):
+    """Cosine annealing from the full rate down to floor*rate over total steps"""
+    return lambda t: floor + (1 - floor) * 0.5 * (1 + np.cos(np.pi * min(t, total) / total))
+
+def warmup(steps, then=None):
+    """Linear warmup over steps, followed by the schedule then"""
+    if then is None:
+        then = constant()
+    return lambda t: (t + 1.0) / steps if t < steps else then(t - steps)
+
+
+class SGD():
+    """Plain gradient descent: weights += rate * deltas"""
+    def __init__(self, alpha, schedule=None):
+        self.alpha = alpha
+        self.schedule = schedule if schedule is not None else constant()
+        self.t = 0
+        self.state = None
+
+    def rate(self):
+        return self.alpha * self.schedule(self.t)
+
+    def init_state(self, params):
+        return [None for _ in params]
+
+    def step(self, params, deltas):
+        if self.state is None:
+            self.state = self.init_state(params)
+        rate = self.rate()
+        self.t += 1
+        for p, d, state in zip(params, deltas, self.state):
+            self.update(p, d, state, rate)
+
+    def update(self, p, d, state, rate):
+        d *= rate
+        p += d
+
+
+class Momentum(SGD):
+    """Heavy ball momentum, or Nesterov's accelerated gradient"""
+    def __init__(self, alpha, mu=0.9, nesterov=False, schedule=None):
+        SGD.__init__(self, alpha, schedule)
+        self.mu = mu
+        self.nesterov = nesterov
+
+    def init_state(self, params):
+        return [np.zeros_like(p) for p in params]
+
+    def update(self, p, d, v, rate):
+        d *= rate
+        v *= self.mu
+        v += d
+        if self.nesterov:
+            p += d
+            np.multiply(v, self.mu, out=d)
+            p += d
+        else:
+            p += v
+
+
+class AdaGrad(SGD):
+    """Per-weight rates scaled by the root of the summed squared deltas"""
+    def __init__(self, alpha, eps=1e-8, schedule=None):
+        SGD.__init__(self, alpha, schedule)
+        self.eps = eps
+
+    def init_state(self, params):
+        return [(np.zeros_like(p), np.empty_like(p)) for p in params]
+
+    def accumulate(self, G, d, tmp):
+        np.square(d, out=tmp)
+        G += tmp
+
+    def update(self, p, d, state, rate):
+        G, tmp = state
+        self.accumulate(G, d, tmp)
+        np.sqrt(G, out=tmp)
+        tmp += self.eps
+        d /= tmp
+        d *= rate
+        p += d
+
+
+class RMSProp(AdaGrad):
+    """AdaGrad with an exponential moving average of squared deltas"""
+    def __init__(self, alpha, rho=0.9, eps=1e-8, schedule=None):
+        AdaGrad.__init__(self, alpha, eps, schedule)
+        self.rho = rho
+
+    def accumulate(self, G, d, tmp):
+        np.square(d, out=tmp)
+        tmp *= 1 - self.rho
+        G *= self.rho
+        G += tmp
+
+
+class Adam(SGD):
+    """Adam, with bias-corrected moving averages of deltas and their squares"""
+    def __init__(self, alpha=0.001, beta1=0.9, beta2=0.999, eps=1e-8, schedule=None):
+        SGD.__init__(self, alpha, schedule)
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.eps = eps
+
+    def init_state(self, params):
+        return [(np.zeros_like(p), np.zeros_like(p), np.empty_like(p)) for p in params]
+
+    def update(self, p, d, state, rate):
+        m, v, tmp = state
+        t = self.t #already counts this step
+        rate = rate * np.sqrt(1 - self.beta2**t) / (1 - self.beta1**t)
+        m *= self.beta1
+        np.multiply(d, 1 - self.beta1, out=tmp)
+        m += tmp
+        v *= self.beta2
+        np.square(d, out=tmp)
+        tmp *= 1 - self.beta2
+        v += tmp
+        np.sqrt(v, out=tmp)
+        tmp += self.eps
+        np.divide(m, tmp, out=d)
+        d *= rate
+        p += d
+
+
+def lbfgs(f, x0, maxiter=100, tol=1e-8, memory=10):
+    """Full-batch L-BFGS with backtracking line search. f(x) returns the
+    loss and its gradient at the flat vector x. Stops when the relative
+    decrease of the loss or the largest gradient entry falls below tol.
+    Returns (x, number of iterations)."""
+    x = x0.copy()
+    fx, g = f(x)
+    S, Y = [], []
+    for it in range(maxiter):
+        #two-loop recursion for the quasi-Newton direction
+        d = -g
+        coefs = []
+        for s, y in reversed(list(zip(S, Y))):
+            a = np.dot(s, d) / np.dot(y, s)
+            d = d - a*y
+            coefs.append(a)
+        if S:
+            d = d * (np.dot(S[-1], Y[-1]) / np.dot(Y[-1], Y[-1]))
+        for (s, y), a in zip(zip(S, Y), reversed(coefs)):
+            b = np.dot(y, d) / np.dot(y, s)
+            d = d + (a - b)*s
+        slope = np.dot(g, d)
+        if slope >= 0: #not a descent direction, restart from the gradient
+            S, Y = [], []
+            d = -g
+            slope = -np.dot(g, g)
+        step = 1.0
+        while True:
+            xnew = x + step*d
+            fnew, gnew = f(xnew)
+            if fnew <= fx + 1e-4*step*slope or step < 1e-10:
+                break
+            step *= 0.5
+        s, y = xnew - x, gnew - g
+        if np.dot(y, s) > 1e-12:
+            S.append(s)
+            Y.append(y)
+            if len(S) > memory:
+                S.pop(0)
+                Y.pop(0)
+        converged = fx - fnew <= tol*max(1.0, abs(fx)) or np.max(np.abs(gnew)) <= tol
+        x, fx, g = xnew, fnew, gnew
+        if converged:
+            break
+    return x, it + 1
@@ -0,0 +1,184 @@
+# Micro-batching inference server for checkpoints of NN and LogisticRegression
+# Requests arrive as JSON lines over a Unix socket or a localhost TCP port:
+#   {"id": 7, "x": [784 floats]}  ->  {"id": 7, "outputs": [...], "label": 3}
+#   {"stats": true}               ->  queue depth, p50/p99 latency, batch sizes
+# Concurrent requests, from one pipelining connection or many, are
+# collected into micro-batches of at most max_batch rows, waiting at most
+# max_wait_us after the first one, and scored with one batched forward pass.
+#
+#   python serve.py CHECKPOINT --unix /tmp/model.sock --max-batch 64 --max-wait-us 500
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from models import loadModule
+
+
+def loadModel(path, mmap_mode='r'):
+    """Loads a checkpoint of either kind (see checkpoint.py); returns
+    (predict, nin) where predict maps rows to (outputs, labels)"""
+    with open(os.path.join(path, "model.json")) as f:
+        kind = json.load(f)["kind"]
+    if kind == "NN":
+        model = loadModule("neuralnet_bias", "neuralnet-bias.py").NN.load(path, mmap_mode)
+        return model.forward_batch, model.sizes[0]
+    if kind == "LogisticRegression":
+        model = loadModule("logreg", "logreg.py").LogisticRegression.load(path, mmap_mode)
+        return model.predict_batch, model.theta.shape[1] - 1
+    raise ValueError("Unknown model kind {0}".format(kind))
+
+
+class MicroBatcher():
+    """Queues single rows and scores them in batches. predict runs on a
+    worker thread (BLAS releases the GIL), so the next batch is collected
+    while the current one is computed."""
+    def __init__(self, predict, max_batch=64, max_wait_us=500, history=10000):
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_wait = max_wait_us / 1e6
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(1)
+        self.latencies = collections.deque(maxlen=history) #seconds, most recent requests
+        self.nrequests = 0
+        self.nbatches = 0
+
+    async def submit(self, x):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((x, future, time.perf_counter()))
+        return await future
+
+    async def collect(self):
+        """Waits for one request, then takes more until the batch is full
+        or max_wait has passed since the first one"""
+        loop = asyncio.get_running_loop()
+        items = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(items) < self.max_batch:
+            if not self.queue.empty():
+                items.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return items
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = await self.collect()
+            X = np.stack([x for x, _, _ in items])
+            try:
+                outputs, labels = await loop.run_in_executor(self.executor, self.predict, X)
+            except Exception as e:
+                for _, future, _ in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            now = time.perf_counter()
+            for i, (_, future, start) in enumerate(items):
+                if not future.done():
+                    future.set_result((outputs[i], labels[i]))
+                self.latencies.append(now - start)
+            self.nrequests += len(items)
+            self.nbatches += 1
+
+    def stats(self):
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {"queue_depth": self.queue.qsize(), "requests": self.nrequests,
+                "batches": self.nbatches,
+                "mean_batch": self.nrequests / max(self.nbatches, 1),
+                "p50_ms": 1000*float(np.percentile(latencies, 50)),
+                "p99_ms": 1000*float(np.percentile(latencies, 99))}
+
+
+async def answer(batcher, nin, request):
+    if not isinstance(request, dict):
+        return {"error": "bad request: expected a JSON object"}
+    if request.get("stats"):
+        return batcher.stats()
+    if "x" not in request:
+        return {"id": request.get("id"), "error": "expected x or stats"}
+    try:
+        x = np.asarray(request["x"], dtype=np.float64)
+    except (TypeError, ValueError):
+        return {"id": request.get("id"), "error": "x must be a list of numbers"}
+    if x.shape != (nin,):
+        return {"id": request.get("id"), "error": "x must have {0} values".format(nin)}
+    try:
+        outputs, label = await batcher.submit(x)
+    except Exception as e:
+        return {"id": request.get("id"), "error": str(e)}
+    return {"id": request.get("id"), "outputs": outputs.tolist(), "label": int(label)}
+
+
+def handler(batcher, nin):
+    async def handle(reader, writer):
+        """Every line is answered by its own task, so a client can pipeline
+        requests; answers may come out of order and carry the request id"""
+        async def reply(line):
+            try:
+                response = await answer(batcher, nin, json.loads(line))
+            except ValueError as e:
+                response = {"error": "bad request: {0}".format(e)}
+            writer.write((json.dumps(response) + "\n").encode())
+
+        pending = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.ensure_future(reply(line))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                await writer.drain()
+            if pending:
+                await asyncio.wait(pending)
+            await writer.drain()
+        finally:
+            writer.close()
+    return handle
+
+
+async def serve(checkpoint, unix=None, host="127.0.0.1", port=8765,
+                max_batch=64, max_wait_us=500):
+    predict, nin = loadModel(checkpoint)
+    batcher = MicroBatcher(predict, max_batch, max_wait_us)
+    worker = asyncio.ensure_future(batcher.run())
+    if unix is not None:
+        server = await asyncio.start_unix_server(handler(batcher, nin), path=unix)
+    else:
+        server = await asyncio.start_server(handler(batcher, nin), host, port)
+    print("Serving {0} on {1}".format(checkpoint, unix if unix is not None else "{0}:{1}".format(host, port)))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        worker.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-batching inference server")
+    parser.add_argument("checkpoint")
+    parser.add_argument("--unix", default=None, help="Unix socket path, instead of TCP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-wait-us", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(serve(args.checkpoint, args.unix, args.host, args.port,
+                      args.max_batch, args.max_wait_us))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,6 @@
 # Inspired by http://dspace.mit.edu/handle/1721.1/6904
 import re
 
-rels = []
-things = {}
-def getThing(name):
-    if name not in things:
-        Object(name)
-    return things[name]
-
 
 class Relation():
     def __init__(self, leftobj, verb, rightobj, negation=False):
@@ -34,9 +27,6 @@ class Relation():
 class Object():
     def __init__(self, name, group=None):
         self.name = name
-        self.relations = []
-        global things
-        things[name] = self
         self.group = group
 
 class Group():
@@ -44,16 +34,7 @@ class Group():
         self.name = name
         self.all = Object("every {0}".format(name), self)
         self.some = Object("a {0}".format(name), self)
-        global things
-        things[name] = self
 
-def classify(obj):
-    if obj.group==None:
-        return "thing"
-    elif obj.group.all == obj:
-        return "every"
-    elif obj.group.some == obj:
-        return "exists"
 
 def compare(rel1, rel2):
     if rel1.leftobj == rel2.leftobj and rel1.verb == rel2.verb and rel1.rightobj == rel2.rightobj:
@@ -65,22 +46,195 @@ def compare(rel1, rel2):
         return 0
 
 
-def parseSentence(text):
-    lexp = "(?P<lexp>(a|an|every|not every|no|)\s*([a-zA-Z]+))"
-    rexp = "(?P<rexp>(a|an|every|)\s*([a-zA-Z]+))"
-    verb_exp = "(?P<verb>((doesn't|)\s*[a-zA-Z]*\s*)|(isn't))"
-    general = "{0} {1} {2}".format(lexp, verb_exp, rexp)
-    pattern = re.compile(general)
-    matches = pattern.match(text)
-    matchdict = matches.groupdict()
+class KnowledgeBase():
+    """Things and the facts relating them. Every edge (a fact, or the
+    mirror of an "is" fact) is indexed by (left, verb), by (verb, right)
+    and by the exact triple, so inference fetches only the edges it can
+    follow instead of scanning everything known about an object."""
+    def __init__(self):
+        self.things = {} #name -> Object or Group
+        self.rels = [] #facts, in the order they were told
+        self.byLeftVerb = {}
+        self.byVerbRight = {}
+        self.byTriple = {}
+        #group membership: the "every X" and "a X" objects of each group
+        self.every = {}
+        self.exists = {}
+
+    def getThing(self, name):
+        if name not in self.things:
+            self.things[name] = Object(name)
+        return self.things[name]
+
+    def getGroup(self, name):
+        if name not in self.things:
+            group = Group(name)
+            self.things[name] = group
+            self.things[group.all.name] = group.all
+            self.things[group.some.name] = group.some
+            self.every[group.all] = group
+            self.exists[group.some] = group
+        return self.things[name]
+
+    def classify(self, obj):
+        if obj in self.every:
+            return "every"
+        elif obj in self.exists:
+            return "exists"
+        return "thing"
+
+    def addEdge(self, rel):
+        self.byLeftVerb.setdefault((rel.leftobj, rel.verb), []).append(rel)
+        self.byVerbRight.setdefault((rel.verb, rel.rightobj), []).append(rel)
+        self.byTriple.setdefault((rel.leftobj, rel.verb, rel.rightobj), []).append(rel)
+
+    def addFact(self, rel):
+        self.addEdge(rel)
+        if rel.verb == "is":
+            self.addEdge(Relation(rel.rightobj, "is", rel.leftobj))
+        self.rels.append(rel)
+
+    def facts(self, leftobj=None, verb=None, rightobj=None):
+        """Edges with the verb and the given left and/or right object"""
+        if leftobj is not None and rightobj is not None:
+            return self.byTriple.get((leftobj, verb, rightobj), [])
+        elif leftobj is not None:
+            return self.byLeftVerb.get((leftobj, verb), [])
+        else:
+            return self.byVerbRight.get((verb, rightobj), [])
+
+    def followable(self, leftobj, verb):
+        """Edges from leftobj that a path for verb can go on through: those
+        with the same verb, and positive "is" edges"""
+        edges = self.facts(leftobj, verb)
+        if verb != "is":
+            edges = edges + [rel for rel in self.facts(leftobj, "is") if not rel.negation]
+        return edges
+
+    def addFactFromSentence(self, text):
+        self.addFact(self.parseSentence(text))
+
+    def parseSentence(self, text):
+        lexp = "(?P<lexp>(a|an|every|not every|no|)\s*([a-zA-Z]+))"
+        rexp = "(?P<rexp>(a|an|every|)\s*([a-zA-Z]+))"
+        verb_exp = "(?P<verb>((doesn't|)\s*[a-zA-Z]*\s*)|(isn't))"
+        general = "{0} {1} {2}".format(lexp, verb_exp, rexp)
+        pattern = re.compile(general)
+        matches = pattern.match(text)
+        matchdict = matches.groupdict()
+
+        leftname, leftneg = self.parseName(matchdict["lexp"])
+        rightname, rightneg = self.parseName(matchdict["rexp"])
+        verbname, verbneg = parseVerb(matchdict["verb"])
+        negation = leftneg ^ verbneg
+
+        return Relation(leftname, verbname, rightname, negation)
+
+    def parseName(self, text): #takes a thing name, returns an object
+        negation = False
+        exp = "(?P<article>(a|an|every|not every|no|))\s*(?P<name>([a-zA-Z]+))"
+        pattern = re.compile(exp)
+        matchdict = pattern.match(text).groupdict()
+        article, name = matchdict["article"], matchdict["name"]
+        if article == "":
+            obj = self.getThing(name)
+        else:
+            group = self.getGroup(name)
+            if article in ["a", "an"]:
+                obj = group.some
+            elif article == "every":
+                obj = group.all
+            elif article == "not every":
+                obj = group.some
+                negation = True
+            elif article == "no":
+                obj = group.all
+                negation = True
+        return obj, negation
+
+    def pathsHelper(self, relChecked, results, stack = [], visited=[], negated=False):
+        leftobj = relChecked.leftobj
+        rightobj = relChecked.rightobj
+        verb = relChecked.verb
+        negated = negated ^ relChecked.negation
+
+        if rightobj == leftobj and verb=="is":
+            results.append((stack, negated))
+
+        if self.classify(leftobj)=="exists":
+            self.pathsHelper(Relation(leftobj.group.all, verb, rightobj), results, stack, visited+[leftobj], negated)
+
+        if leftobj in visited:
+            return
+
+        #edges stating relChecked itself, either way
+        for relation in self.facts(leftobj, verb, rightobj):
+            results.append((stack+[relation], negated^relation.negation))
+
+        for relation in self.followable(leftobj, verb):
+            kind = self.classify(relation.rightobj)
+            if kind == "exists":
+                if relation.verb == verb:
+                    newRelation = Relation(relation.rightobj.group.all, "is", rightobj, relation.negation)
+                else:
+                    newRelation = Relation(relation.rightobj.group.all, verb, rightobj, relation.negation)
 
-    leftname, leftneg = parseName(matchdict["lexp"])
-    rightname, rightneg = parseName(matchdict["rexp"])
-    verbname, verbneg = parseVerb(matchdict["verb"])
-    negation = leftneg ^ verbneg
+            elif kind == "every":
+                if relation.verb == verb:
+                    newRelation = Relation(relation.rightobj.group.some, "is", rightobj, relation.negation)
+                else:
+                    newRelation = Relation(relation.rightobj.group.some, verb, rightobj)
+
+            else:
+                if relation.verb == verb:
+                    newRelation = Relation(relation.rightobj, "is", rightobj, relation.negation)
+                else:
+                    newRelation = Relation(relation.rightobj, verb, rightobj, relation.negation)
+            self.pathsHelper(newRelation, results, stack+[relation], visited+[leftobj], negated)
+
+    def getPaths(self, relChecked):
+        results = []
+        self.pathsHelper(relChecked, results)
+        return results
+
+    def check(self, rel):
+        paths = []
+        if self.classify(rel.leftobj) == "every":
+            converted = Relation(rel.leftobj.group.some, rel.verb, rel.rightobj, not rel.negation)
+            if any([path[1]==False for path in self.getPaths(converted)]):
+                return -1
+
+        paths = self.getPaths(rel)
+
+        if len(paths)==0:
+            return 0
+        else:
+            if self.classify(rel.leftobj) == "exists":
+                if any([path[1]==False for path in paths]):
+                    return True
+
+            if all([path[1]==True for path in paths]):
+                return -1
+            elif all([path[1]==False for path in paths]):
+                return 1
+            else:
+                print("WARNING: contradictory information")
+                return 0
+
+    def respond(self, inp):
+        if inp[-1] == "?":
+            text = inp[:-1]
+            result = self.check(self.parseSentence(text))
+            if result==1:
+                return "    Yes"
+            elif result==-1:
+                return "    No"
+            else:
+                return "    Not sure"
+        else:
+            self.addFactFromSentence(inp)
+            return "    I understand"
 
-    
-    return Relation(leftname, verbname, rightname, negation)
 
 def parseVerb(text):
     if "isn't" not in text and "doesn't" not in text:
@@ -91,147 +245,19 @@ def parseVerb(text):
         return text.split()[1]+"s", True
 
 
-def parseName(text): #takes a thing name, returns an object
-    negation = False
-    exp = "(?P<article>(a|an|every|not every|no|))\s*(?P<name>([a-zA-Z]+))"
-    pattern = re.compile(exp)
-    matchdict = pattern.match(text).groupdict()
-    article, name = matchdict["article"], matchdict["name"]
-    if article == "":
-        obj = getThing(name)
-    else:
-        if name not in things:
-            Group(name)
-        
-        if article in ["a", "an"]:
-            obj = getThing(name).some
-        elif article == "every":
-            obj = getThing(name).all
-        elif article == "not every":
-            obj = getThing(name).some
-            negation = True
-        elif article == "no":
-            obj = getThing(name).all
-            negation = True
-    return obj, negation
-
-
-
-def addFact(rel):
-    leftobj = rel.leftobj
-    rightobj = rel.rightobj
-    leftobj.relations.append(rel)
-    if rel.verb == "is":
-        reflexed = Relation(rightobj, "is", leftobj)
-        rightobj.relations.append(reflexed)
-    global rels
-    rels.append(rel)
-
-
-def addFactFromSentence(text):
-    addFact(parseSentence(text))
-
-
-results = []
-def pathsHelper(relChecked, stack = [], visited=[], negated=False):
-    leftobj = relChecked.leftobj
-    rightobj = relChecked.rightobj
-    verb = relChecked.verb
-    negated = negated ^ relChecked.negation
-
-    if rightobj == leftobj and verb=="is":
-        results.append((stack, negated))
-
-    if classify(leftobj)=="exists":
-        pathsHelper(Relation(leftobj.group.all, verb, rightobj), stack, visited+[leftobj], negated)
-
-    for relation in leftobj.relations:
-        if relation.leftobj in visited:
-            continue
-
-        if compare(relation, relChecked) != 0:
-            results.append((stack+[relation], negated^relation.negation))
-
-        if classify(relation.rightobj) == "exists":
-            if relation.verb == verb:
-                newRelation = Relation(relation.rightobj.group.all, "is", rightobj, relation.negation)
-                pathsHelper(newRelation, stack+[relation], visited+[leftobj], negated)
-            elif relation.verb == "is" and not relation.negation:
-                newRelation = Relation(relation.rightobj.group.all, verb, rightobj, relation.negation)
-                pathsHelper(newRelation, stack+[relation], visited+[leftobj], negated)
-
-        elif classify(relation.rightobj) == "every":
-            if relation.verb == verb:
-                newRelation = Relation(relation.rightobj.group.some, "is", rightobj, relation.negation)
-                pathsHelper(newRelation, stack+[relation], visited+[leftobj], negated)
-            elif relation.verb == "is" and not relation.negation:
-                newRelation = Relation(relation.rightobj.group.some, verb, rightobj)
-                pathsHelper(newRelation, stack+[relation], visited+[leftobj], negated)
-
-        else:
-            if relation.verb == verb:
-                newRelation = Relation(relation.rightobj, "is", rightobj, relation.negation)
-                pathsHelper(newRelation, stack+[relation], visited+[leftobj], negated)
-            elif relation.verb == "is" and not relation.negation:
-                newRelation = Relation(relation.rightobj, verb, rightobj, relation.negation)
-                pathsHelper(newRelation, stack+[relation], visited+[leftobj], negated)
-
-def getPaths(relChecked):
-    global results
-    results = []
-    pathsHelper(relChecked)
-    return results
-    
 
 def showPath(path):
     print([p.show() for p in path])
 
-def check(rel):
-    paths = []
-    if classify(rel.leftobj) == "every":
-        converted = Relation(rel.leftobj.group.some, rel.verb, rel.rightobj, not rel.negation)
-        if any([path[1]==False for path in getPaths(converted)]):
-            return -1
-
-    paths = getPaths(rel)
-    
-    if len(paths)==0:
-        return 0
-    else:
-        if classify(rel.leftobj) == "exists":
-            if any([path[1]==False for path in paths]):
-                return True
-
-        if all([path[1]==True for path in paths]):
-            return -1
-        elif all([path[1]==False for path in paths]):
-            return 1
-        else:
-            print("WARNING: contradictory information")
-            return 0
-
-def respond(inp):
-    if inp[-1] == "?":
-        text = inp[:-1]
-        result = check(parseSentence(text))
-        if result==1:
-            return "    Yes"
-        elif result==-1:
-            return "    No"
-        else:
-            return "    Not sure"
-    else:
-        addFactFromSentence(inp)
-        return "    I understand"
-
 
 def mainLoop():
+    kb = KnowledgeBase()
     inp = input(": ")
     while True:
         if inp=="exit":
             return
         else:
-            print(respond(inp))
+            print(kb.respond(inp))
             inp = input(": ")
 
 
@@ -0,0 +1,70 @@
+# Compressed sparse row (CSR) data for logreg.py
+# Works on anything with data, indices, indptr and shape attributes, so a
+# scipy.sparse.csr_matrix can be passed as is, but scipy is not needed:
+# CSR below holds the same three arrays. Rows are datapoints, as in the
+# batch APIs of the learners, and all costs scale with the nonzeros.
+
+import numpy as np
+
+
+class CSR():
+    def __init__(self, data, indices, indptr, shape):
+        self.data = np.asarray(data)
+        self.indices = np.asarray(indices)
+        self.indptr = np.asarray(indptr)
+        self.shape = tuple(shape)
+
+
+def csrFromDense(A):
+    A = np.asarray(A)
+    rows, cols = np.nonzero(A)
+    indptr = np.zeros(A.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=A.shape[0]), out=indptr[1:])
+    return CSR(A[rows, cols], cols, indptr, A.shape)
+
+
+def rowIds(X):
+    """Row of every stored entry"""
+    return np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+
+
+def takeRows(X, idx):
+    """CSR of the rows idx of X, gathered without a Python loop"""
+    idx = np.asarray(idx)
+    starts, ends = X.indptr[idx], X.indptr[idx+1]
+    lengths = ends - starts
+    indptr = np.zeros(len(idx) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    #position of every gathered entry in the original arrays
+    pos = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+    return CSR(X.data[pos], X.indices[pos], indptr, (len(idx), X.shape[1]))
+
+
+def sumRows(values, indptr):
+    """Sums consecutive groups of rows of values, delimited by indptr;
+    empty groups give zeros"""
+    out = np.zeros((len(indptr) - 1,) + values.shape[1:], values.dtype)
+    nonempty = np.diff(indptr) > 0
+    if np.any(nonempty):
+        out[nonempty] = np.add.reduceat(values[indptr[0]:indptr[-1]],
+                                        indptr[:-1][nonempty] - indptr[0])
+    return out
+
+
+def dotDense(X, W):
+    """X @ W.T for CSR X (m, nin) and dense W (nout, nin): only the
+    columns of W for stored entries are read"""
+    contrib = W.T[X.indices] * X.data[:, None]
+    return sumRows(contrib, X.indptr)
+
+
+def sparseOuter(delta, X):
+    """delta.T @ X for dense delta (m, nout) and CSR X (m, nin), restricted
+    to the active columns of X. Returns (cols, G) with G of shape
+    (nout, len(cols)), the only nonzero columns of the full product."""
+    cols, inverse = np.unique(X.indices[X.indptr[0]:X.indptr[-1]], return_inverse=True)
+    contrib = delta[rowIds(X)] * X.data[X.indptr[0]:X.indptr[-1], None]
+    order = np.argsort(inverse, kind='stable')
+    starts = np.searchsorted(inverse[order], np.arange(len(cols)))
+    G = np.add.reduceat(contrib[order], starts) if len(cols) else np.zeros((0, delta.shape[1]))
+    return cols, G.T
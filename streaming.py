@@ -0,0 +1,123 @@
+# Out-of-core training for logreg.py and neuralnet-bias.py
+# Data arrives as an iterator of (X_chunk, y_chunk) pairs, one datapoint
+# per row, e.g. slices of memmaps or arrays read from files. Chunks are
+# read ahead on a background thread and mixed in a bounded shuffle buffer,
+# so memory stays flat however large the dataset is.
+
+import threading
+import queue
+import numpy as np
+
+
+def arrayChunks(X, y, chunksize=10000):
+    """Chunks of arrays such as the memmaps from loadMnist; slicing a
+    memmap reads nothing until the rows are used"""
+    for start in range(0, len(X), chunksize):
+        yield X[start:start+chunksize], y[start:start+chunksize]
+
+
+def fileChunks(paths, chunksize=10000):
+    """Chunks of at most chunksize rows from pairs of .npy files, each
+    memory-mapped and sliced like arrayChunks, so no file is read whole"""
+    for Xpath, ypath in paths:
+        for chunk in arrayChunks(np.load(Xpath, mmap_mode='r'), np.load(ypath, mmap_mode='r'), chunksize):
+            yield chunk
+
+
+def prefetch(chunks, depth=2):
+    """Pulls up to depth chunks ahead on a background thread, reading them
+    into memory there (memmap slices would otherwise be read by the
+    consumer). Exceptions from the iterator are raised in the consumer."""
+    q = queue.Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for chunk in chunks:
+                q.put(tuple(np.array(a) for a in chunk))
+            q.put(done)
+        except Exception as e:
+            q.put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    while True:
+        item = q.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def rebatch(blocks, batchsize):
+    """Mini-batches of batchsize rows (the last may be smaller) from
+    (X, y) blocks of any size; rows are copied at most once, when a batch
+    straddles two blocks"""
+    Xcarry = ycarry = None
+    for Xb, yb in blocks:
+        start = 0
+        if Xcarry is not None:
+            start = batchsize - len(Xcarry)
+            Xcarry = np.concatenate([Xcarry, Xb[:start]])
+            ycarry = np.concatenate([ycarry, yb[:start]])
+            if len(Xcarry) < batchsize:
+                continue
+            yield Xcarry, ycarry
+            Xcarry = ycarry = None
+        while len(Xb) - start >= batchsize:
+            yield Xb[start:start+batchsize], yb[start:start+batchsize]
+            start += batchsize
+        if start < len(Xb):
+            Xcarry, ycarry = Xb[start:], yb[start:]
+    if Xcarry is not None:
+        yield Xcarry, ycarry
+
+
+def shuffledBatches(chunks, batchsize, buffersize=10000):
+    """Mini-batches drawn from a buffer of buffersize rows. Each incoming
+    row takes the place of a random buffered row, which is emitted; at the
+    end the buffer is flushed in random order."""
+    return rebatch(shuffledRows(chunks, buffersize), batchsize)
+
+
+def shuffledRows(chunks, buffersize):
+    """Blocks of rows emitted by the shuffle buffer of shuffledBatches"""
+    Xbuf = ybuf = None
+    filled = 0
+    for Xc, yc in chunks:
+        Xc, yc = np.asarray(Xc), np.asarray(yc)
+        if Xbuf is None:
+            Xbuf = np.empty((buffersize,) + Xc.shape[1:], Xc.dtype)
+            ybuf = np.empty((buffersize,) + yc.shape[1:], yc.dtype)
+        start = 0
+        #fill the buffer first
+        if filled < buffersize:
+            n = min(buffersize - filled, len(Xc))
+            Xbuf[filled:filled+n] = Xc[:n]
+            ybuf[filled:filled+n] = yc[:n]
+            filled += n
+            start = n
+        #then swap rows in, at most buffersize at a time so slots are distinct
+        while start < len(Xc):
+            n = min(buffersize, len(Xc) - start)
+            slots = np.random.choice(buffersize, n, replace=False)
+            Xout, yout = Xbuf[slots], ybuf[slots]
+            Xbuf[slots] = Xc[start:start+n]
+            ybuf[slots] = yc[start:start+n]
+            start += n
+            yield Xout, yout
+    if Xbuf is None:
+        return
+    order = np.random.permutation(filled)
+    yield Xbuf[order], ybuf[order]
+
+
+def streamTrain(model, chunks, batchsize=100, buffersize=10000, depth=2, **kwargs):
+    """One pass over chunks, calling model.partial_fit on shuffled
+    mini-batches; kwargs go to partial_fit. Returns the number of steps."""
+    nsteps = 0
+    for Xb, yb in shuffledBatches(prefetch(chunks, depth), batchsize, buffersize):
+        model.partial_fit(Xb, yb, **kwargs)
+        nsteps += 1
+    return nsteps
@@ -0,0 +1,175 @@
+# Parallel hyperparameter sweeps for logreg.py and neuralnet-bias.py
+# The dataset is loaded once and copied into shared memory before a pool
+# of worker processes is forked, so no worker reloads or copies it. Grid
+# or random configurations are trained in parallel, with successive
+# halving: all trials get a small budget, the best 1/eta of them go on
+# with eta times more iterations, and so on.
+#
+#   OMP_NUM_THREADS=1 python sweep.py --model nn --random 24 [--synthetic]
+
+import argparse
+import itertools
+import multiprocessing as mp
+import numpy as np
+
+from mnistdata import syntheticMnist
+from models import loadModule
+
+DATA = {} #shared (X, y) per split, set before the workers are forked
+MODULES = {}
+
+
+def shareArray(ctx, A):
+    """Copy of A in shared memory, visible to forked processes"""
+    raw = ctx.RawArray('b', A.nbytes)
+    shared = np.frombuffer(raw, dtype=A.dtype).reshape(A.shape)
+    shared[...] = A
+    return shared
+
+
+def grid(space):
+    """Every combination of the lists of values in the dict space"""
+    keys = sorted(space)
+    return [dict(zip(keys, values)) for values in itertools.product(*[space[k] for k in keys])]
+
+
+def randomConfigs(space, n, seed=0):
+    """n configurations, each value drawn from its list in space, or by
+    calling it with a RandomState"""
+    rng = np.random.RandomState(seed)
+    configs = []
+    for _ in range(n):
+        config = {}
+        for key in sorted(space):
+            values = space[key]
+            config[key] = values(rng) if callable(values) else values[rng.randint(len(values))]
+        configs.append(config)
+    return configs
+
+
+def buildModel(config, nin, nout):
+    if config["model"] == "NN":
+        if "NN" not in MODULES:
+            MODULES["NN"] = loadModule("neuralnet_bias", "neuralnet-bias.py")
+        sizes = [nin] + list(config.get("hidden", [])) + [nout]
+        return MODULES["NN"].NN(len(sizes), sizes, g=config.get("activation"),
+                                dtype=np.dtype(config.get("dtype", "float64")))
+    if config["model"] == "LogisticRegression":
+        if "LogisticRegression" not in MODULES:
+            MODULES["LogisticRegression"] = loadModule("logreg", "logreg.py")
+        return MODULES["LogisticRegression"].LogisticRegression(
+            nin, nout, multinomial=config.get("multinomial", False))
+    raise ValueError("Unknown model {0}".format(config["model"]))
+
+
+def getWeights(model):
+    if hasattr(model, "thetas"):
+        return [np.array(w) for w in model.thetas + model.biases]
+    return [np.array(model.theta)]
+
+def setWeights(model, weights):
+    if hasattr(model, "thetas"):
+        n = len(model.thetas)
+        model.thetas = [w.astype(model.dtype) for w in weights[:n]]
+        model.biases = [w.astype(model.dtype) for w in weights[n:]]
+    else:
+        model.theta = weights[0]
+
+
+def runTrial(job):
+    """Trains one configuration for niter more steps, starting from weights
+    if given; returns (validation accuracy, weights)"""
+    config, weights, niter, seed = job
+    X, y = DATA["train"]
+    Xv, yv = DATA["valid"]
+    nout = int(max(y.max(), yv.max())) + 1
+    np.random.seed(seed) #before the initial weights are drawn, so they do not depend on the worker
+    model = buildModel(config, X.shape[1], nout)
+    if weights is not None:
+        setWeights(model, weights)
+    for t in range(niter):
+        idx = np.random.randint(0, len(X), size=config["batchsize"])
+        model.partial_fit(X[idx], y[idx], alpha=config["alpha"])
+    predict = model.forward_batch if hasattr(model, "thetas") else model.predict_batch
+    accuracy = float(np.mean(predict(Xv)[1] == yv))
+    return accuracy, getWeights(model)
+
+
+def sweep(configs, train, valid, nworkers=None, min_iter=100, eta=3, max_iter=2700, seed=0):
+    """Successive halving over configs (each a dict with at least "model",
+    "alpha" and "batchsize"), on (X, y) training and validation splits
+    with one datapoint per row. With min_iter == max_iter every trial gets
+    the full budget. Returns one row per trial, best first."""
+    ctx = mp.get_context("fork")
+    DATA["train"] = (shareArray(ctx, np.asarray(train[0])), shareArray(ctx, np.asarray(train[1])))
+    DATA["valid"] = (shareArray(ctx, np.asarray(valid[0])), shareArray(ctx, np.asarray(valid[1])))
+    rows = [{"trial": i, "config": config, "iterations": 0, "accuracy": None}
+            for i, config in enumerate(configs)]
+    weights = [None for _ in configs]
+    alive = list(range(len(configs)))
+    budget = min_iter
+    pool = ctx.Pool(nworkers)
+    try:
+        while alive:
+            niter = min(budget, max_iter) - rows[alive[0]]["iterations"]
+            jobs = [(configs[i], weights[i], niter, seed + 1000*i + rows[i]["iterations"])
+                    for i in alive]
+            for i, (accuracy, w) in zip(alive, pool.map(runTrial, jobs)):
+                rows[i]["accuracy"] = accuracy
+                rows[i]["iterations"] += niter
+                weights[i] = w
+            print("{0} trials at {1} iterations, best accuracy {2}".format(
+                len(alive), min(budget, max_iter), max(rows[i]["accuracy"] for i in alive)))
+            if budget >= max_iter or len(alive) == 1:
+                break
+            alive = sorted(alive, key=lambda i: -rows[i]["accuracy"])[:max(1, len(alive) // eta)]
+            budget *= eta
+    finally:
+        pool.close()
+        pool.join()
+        DATA.clear()
+    return sorted(rows, key=lambda row: (-row["iterations"], -row["accuracy"]))
+
+
+def showTable(rows):
+    keys = sorted(set(k for row in rows for k in row["config"]))
+    header = ["trial", "iterations", "accuracy"] + keys
+    lines = [[str(row["trial"]), str(row["iterations"]), "{0:.4f}".format(row["accuracy"])] +
+             [str(row["config"].get(k, "")) for k in keys] for row in rows]
+    widths = [max(len(line[c]) for line in lines + [header]) for c in range(len(header))]
+    return "\n".join("  ".join(cell.ljust(w) for cell, w in zip(line, widths))
+                     for line in [header] + lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep over NN or LogisticRegression")
+    parser.add_argument("--model", choices=["nn", "logreg"], default="nn")
+    parser.add_argument("--random", type=int, default=0, help="number of random configurations (default: full grid)")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--min-iter", type=int, default=100)
+    parser.add_argument("--max-iter", type=int, default=2700)
+    parser.add_argument("--eta", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--synthetic", action="store_true", help="synthetic data instead of MNIST")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        X, y = syntheticMnist(22000, seed=args.seed)
+        train, valid = (X[:20000], y[:20000]), (X[20000:], y[20000:])
+    else:
+        from mnistdata import loadMnist
+        train, valid, _ = loadMnist()
+    if args.model == "nn":
+        space = {"model": ["NN"], "alpha": [0.05, 0.1, 0.5, 1.0], "batchsize": [10, 50, 100],
+                 "hidden": [(30,), (50,), (100,)], "dtype": ["float32"]}
+    else:
+        space = {"model": ["LogisticRegression"], "alpha": [0.01, 0.05, 0.15, 0.5],
+                 "batchsize": [10, 100, 1000], "multinomial": [False, True]}
+    configs = randomConfigs(space, args.random, args.seed) if args.random else grid(space)
+    rows = sweep(configs, train, valid, args.workers, args.min_iter, args.eta,
+                 args.max_iter, args.seed)
+    print(showTable(rows))
+
+
+if __name__ == "__main__":
+    main()